@@ -0,0 +1,40 @@
+import logging
+from argparse import ArgumentParser
+
+import pandas as pd
+from astropy.table import Table
+
+from scriptutils.catalog import write_run_catalog
+from scriptutils.log import setup_logging
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--runlist", required=True)
+    parser.add_argument("--runlist-checked", required=True)
+    parser.add_argument("--datachecks", required=True)
+    parser.add_argument("-o", "--output-path", required=True)
+    parser.add_argument("--log-file")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    setup_logging(logfile=args.log_file, verbose=args.verbose)
+
+    runs = pd.read_csv(args.runlist, dtype={"Run ID": str})
+    checked = pd.read_csv(args.runlist_checked, dtype={"Run ID": str})
+    runsummary = Table.read(args.datachecks)
+
+    run_id_strs = {int(r): r for r in runs["Run ID"]}
+    nights = {
+        int(r): str(night) for r, night in zip(runs["Run ID"], runs["Date directory"])
+    }
+    selected = {int(r) for r in checked["Run ID"]}
+    log.info(f"{len(selected)} of {len(runsummary)} runs are selected")
+
+    write_run_catalog(args.output_path, runsummary, run_id_strs, nights, selected)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,18 @@
 import logging
 from argparse import ArgumentParser
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from astroplan.moon import moon_illumination
 from astropy import units as u
-from astropy.coordinates import AltAz, EarthLocation, SkyCoord, get_moon
 from astropy.table import Table
 from astropy.time import Time
 
 from scriptutils.config import Config
+from scriptutils.cuts import QUALITY_CUTS, evaluate_cuts
+from scriptutils.datacheck import load_per_run_columns
 from scriptutils.log import setup_logging
-from scriptutils.stats import bounds_std as bounds
+from scriptutils.moon import MoonEphemeris
 
 log = logging.getLogger(__name__)
 
@@ -23,21 +24,6 @@ def get_mask(x, le=np.inf, ge=-np.inf):
     )
 
 
-def get_moon_info(runsummary):
-    location = EarthLocation.from_geodetic(
-        u.Quantity(-17.89139, u.deg),
-        u.Quantity(28.76139, u.deg),
-        height=u.Quantity(2184, u.m),
-    )
-
-    time = Time(runsummary["time"], format="unix", scale="utc")
-    altaz = AltAz(obstime=time, location=location)
-    moon = get_moon(time, location=location).transform_to(altaz)
-
-    moon_light = moon_illumination(time)
-    return moon.alt.to_value(u.deg), moon_light
-
-
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("input_path")
@@ -46,6 +32,11 @@ if __name__ == "__main__":
     parser.add_argument("--output-datachecks", required=True)
     parser.add_argument("--output-config", required=True)
     parser.add_argument("-c", "--config", required=True)
+    parser.add_argument(
+        "--cache",
+        help="Per-run checks of previous calls, only new or changed runs get checked",
+    )
+    parser.add_argument("--moon-ephemeris", help="npz file caching the moon ephemeris")
     parser.add_argument("--log-file")
     parser.add_argument("-v", "--verbose", action="store_true")
     args = parser.parse_args()
@@ -75,32 +66,15 @@ if __name__ == "__main__":
         f"{np.count_nonzero(mask_run_id)} / {len(runsummary)} ",
     )
 
-    mask_pedestals_ok = np.isfinite(runsummary["num_pedestals"])
-
-    # Exclude runs that are too far from source
-
-    tel_pointing = SkyCoord(
-        ra=runsummary["mean_ra"],
-        dec=runsummary["mean_dec"],
-    )
-
-    source_coordinates = SkyCoord(
-        ra=config.source_ra_deg,
-        dec=config.source_dec_deg,
-        unit=u.deg,
-    )
-
-    separation = tel_pointing.separation(source_coordinates)
-
-    mask_separation_low = np.isclose(
-        u.Quantity(0.4, u.deg),
-        separation,
-        rtol=0,
-        atol=0.15,
+    per_run = load_per_run_columns(
+        runsummary,
+        config,
+        Path(args.cache) if args.cache is not None else None,
+        MoonEphemeris(cache=args.moon_ephemeris),
     )
-
-    zenith = 90 - np.rad2deg(runsummary["mean_altitude"])
-    mask_zenith = zenith < config.max_zenith_deg
+    mask_pedestals_ok = per_run["mask_pedestals_ok"]
+    mask_separation_low = per_run["mask_separation_low"]
+    mask_zenith = per_run["mask_zenith"]
 
     mask = (
         mask_pedestals_ok & mask_run_id & mask_time & mask_separation_low & mask_zenith
@@ -130,144 +104,34 @@ if __name__ == "__main__":
         f"Selected runs after blacklist: {list(runsummary['runnumber'][mask].data)}",
     )
 
-    location = EarthLocation.from_geodetic(
-        u.Quantity(-17.89139, u.deg),
-        u.Quantity(28.76139, u.deg),
-        height=u.Quantity(2184, u.m),
-    )
-
-    altaz = AltAz(obstime=time[mask], location=location)
-
-    ped_std = runsummary["ped_charge_stddev"]
-
-    ped_ll = config.pedestal.ll
-    ped_ul = config.pedestal.ul
-
-    if config.pedestal.sigma is not None:
-        sigma = config.pedestal.sigma
+    # Pedestal charge (for runs with moon below horizon) and cosmics rates.
+    # Sigma based bounds use the runs selected by the previous stages
+    cut_masks, cut_bounds = evaluate_cuts(
+        runsummary,
+        [config],
+        mask,
+        reference_masks={"moon_below_horizon": per_run["moon_altitude"] < 0},
+    )
+    for i, cut in enumerate(QUALITY_CUTS):
+        runsummary[cut.name] = cut_masks[0, i]
+        limits = getattr(config, cut.limits)
+        ll, ul = cut_bounds[0, i]
+        if limits.sigma is not None:
+            log.info(
+                "Calculated %f sigma interval of %s is (%f, %f)",
+                limits.sigma,
+                cut.column,
+                ll,
+                ul,
+            )
+        setattr(output_config, cut.limits, {"ul": ul, "ll": ll, "sigma": None})
+        mask = mask & cut_masks[0, i]
         log.info(
-            "Calculating pedestal cuts based on configured sigma interval "
-            "for runs selected before and with moon below horizon.",
+            f"After the cut on {cut.column}, {np.count_nonzero(mask)} runs are kept.",
         )
-
-        altaz = AltAz(obstime=time, location=location)
-        moon = get_moon(time, location=location).transform_to(altaz)
-
-        ped_ll, ped_ul = bounds(ped_std[mask & (moon.alt.to_value(u.deg) < 0)], sigma)
-
-        log.info("Calculated %f sigma interval is (%f, %f)", sigma, ped_ll, ped_ul)
-
-    mask_pedestal_charge = get_mask(ped_std, ge=ped_ll, le=ped_ul)
-
-    runsummary["mask_pedestal_charge"] = mask_pedestal_charge
-    mask = runsummary["mask_pedestal_charge"] & mask
-
-    after_pedestal_charge = np.count_nonzero(mask)
-    s = (
-        "After checking for the deviation of the pedestal charges, "
-        "possibly dependent on the moon elevation and illumination, "
-        f"{after_pedestal_charge} runs are kept."
+    runsummary["mask_cosmics_above"] = (
+        runsummary["mask_cosmics_above10"] & runsummary["mask_cosmics_above30"]
     )
-    log.info(s)
-
-    # Check cosmics rates
-
-    cosmics_rate = runsummary["cosmics_rate"]
-
-    cos_ll = config.cosmics.ll
-    cos_ul = config.cosmics.ul
-
-    if config.cosmics.sigma is not None:
-        sigma = config.cosmics.sigma
-        log.info(
-            "Calculating cosmics cuts based on "
-            "configured sigma interval "
-            "for runs selected before.",
-        )
-
-        cos_ll, cos_ul = bounds(cosmics_rate[mask], sigma)
-
-        log.info("Calculated %f sigma interval is (%f, %f)", sigma, cos_ll, cos_ul)
-
-    mask_cosmics = get_mask(cosmics_rate, ge=cos_ll, le=cos_ul)
-
-    runsummary["mask_cosmics"] = mask_cosmics
-
-    mask = runsummary["mask_cosmics"] & mask
-
-    after_cosmics = np.count_nonzero(mask)
-    s = (
-        "After checking the rate of cosmics and selecting "
-        "based on AGN Zoo Paper cuts, "
-        f"{after_cosmics} runs are kept."
-    )
-    log.info(s)
-
-    cosmics_rate_above10 = runsummary["cosmics_rate_above10"]
-    cosmics_rate_above30 = runsummary["cosmics_rate_above30"]
-
-    cos_10_ll = config.cosmics_10.ll
-    cos_10_ul = config.cosmics_10.ul
-
-    if config.cosmics_10.sigma is not None:
-        sigma = config.cosmics_10.sigma
-        log.info(
-            "Calculating cosmics above 10 cuts based "
-            "on configured sigma interval "
-            "for runs selected before.",
-        )
-
-        cos_10_ll, cos_10_ul = bounds(cosmics_rate_above10[mask], sigma)
-
-        log.info(
-            "Calculated %f sigma interval is (%f, %f)",
-            sigma,
-            cos_10_ll,
-            cos_10_ul,
-        )
-
-    cos_30_ll = config.cosmics_30.ll
-    cos_30_ul = config.cosmics_30.ul
-
-    if config.cosmics_30.sigma is not None:
-        sigma = config.cosmics_30.sigma
-        log.info(
-            "Calculating cosmics above 30 cuts based "
-            "on configured sigma interval for "
-            "runs selected before.",
-        )
-
-        cos_30_ll, cos_30_ul = bounds(cosmics_rate_above30[mask], sigma)
-
-        log.info(
-            "Calculated %f sigma interval is (%f, %f)",
-            sigma,
-            cos_30_ll,
-            cos_30_ul,
-        )
-
-    mask_above10 = get_mask(
-        cosmics_rate_above10,
-        le=cos_10_ul,
-        ge=cos_10_ll,
-    )
-    mask_above30 = get_mask(
-        cosmics_rate_above30,
-        le=cos_30_ul,
-        ge=cos_30_ll,
-    )
-
-    mask_above = mask_above10 & mask_above30
-    runsummary["mask_cosmics_above"] = mask_above
-    mask = runsummary["mask_cosmics_above"] & mask
-
-    after_cosmics_above_n = np.count_nonzero(mask)
-    s = (
-        "After cutting on the rate of cosmics with more than 10 p.e. "
-        f"(resp. 30 p.e.) {after_cosmics_above_n} runs are kept."
-    )
-    log.info(s)
-
     duration = np.sum(runsummary["elapsed_time"][mask].quantity).to(u.h)
     s = (
         f"Selected a total of {np.count_nonzero(mask)} runs "
@@ -286,9 +150,8 @@ if __name__ == "__main__":
     )
     runsummary["mask_whitelist"] = mask_whitelist
     runsummary["mask_final"] = mask
-    moon_alt, moon_ill = get_moon_info(runsummary)
-    runsummary["moon_altitude"] = moon_alt
-    runsummary["moon_illumination"] = moon_ill
+    runsummary["moon_altitude"] = per_run["moon_altitude"]
+    runsummary["moon_illumination"] = per_run["moon_illumination"]
 
     run_mask = np.in1d(run_ids, runsummary["runnumber"][mask])
     runs[run_mask].to_csv(args.output_runlist, index=False)
@@ -301,9 +164,5 @@ if __name__ == "__main__":
         compression=True,
     )
 
-    output_config.pedestal = {"ul": ped_ul, "ll": ped_ll, "sigma": None}
-    output_config.cosmics = {"ul": cos_ul, "ll": cos_ll, "sigma": None}
-    output_config.cosmics_10 = {"ul": cos_10_ul, "ll": cos_10_ll, "sigma": None}
-    output_config.cosmics_30 = {"ul": cos_30_ul, "ll": cos_30_ll, "sigma": None}
     with open(args.output_config, "w") as f:
         f.write(output_config.json())
@@ -1,7 +1,5 @@
-import json
 import logging
 from argparse import ArgumentParser
-from itertools import chain
 
 import astropy.units as u
 import numpy as np
@@ -9,6 +7,7 @@ from astropy.coordinates import AltAz, EarthLocation
 from astropy.table import Table
 from astropy.time import Time
 
+from scriptutils.catalog import read_run_catalog
 from scriptutils.log import setup_logging
 
 log = logging.getLogger(__name__)
@@ -66,29 +65,30 @@ def get_pointings_of_irfs(filelist) -> AltAz:
 
 def main() -> None:
     parser = ArgumentParser()
-    parser.add_argument("--runs", required=True)
-    parser.add_argument("--runsummary", required=True)
+    parser.add_argument("--catalog", required=True)
     parser.add_argument("-o", "--output-path", required=True)
     parser.add_argument("--log-file")
     parser.add_argument("-v", "--verbose", action="store_true")
     args = parser.parse_args()
     setup_logging(logfile=args.log_file, verbose=args.verbose)
 
-    # Note: this could just as well be constructed from the mask_ columns
-    # although maybe then the white/black lists are not included
-    with open(args.runs, "r") as f:
-        runs = json.load(f)
-
-    run_ids = np.array(list(chain(*runs.values())), dtype=int)
-    log.info(run_ids)
-    runsummary = Table.read(args.runsummary)
-
-    mask = np.in1d(runsummary["runnumber"], run_ids)
-    log.info(mask.sum())
+    runs = read_run_catalog(
+        args.catalog,
+        "selected",
+        columns=[
+            "run_id",
+            "mean_altitude",
+            "mean_azimuth",
+            "cosmics_rate",
+            "cosmics_rate_above10",
+            "cosmics_rate_above30",
+        ],
+    )
+    log.info(runs["run_id"])
 
     pointings = AltAz(
-        alt=u.Quantity(runsummary[mask]["mean_altitude"].value, u.rad),
-        az=u.Quantity(runsummary[mask]["mean_azimuth"].value, u.rad),
+        alt=u.Quantity(runs["mean_altitude"], u.rad),
+        az=u.Quantity(runs["mean_azimuth"], u.rad),
     )
     log.info(pointings)
 
@@ -102,10 +102,10 @@ def main() -> None:
     table["alt"] = pointings.alt
     table["az"] = pointings.az
     table["zen"] = pointings.zen
-    table["run_id"] = runsummary[mask]["runnumber"]
-    table["cosmics_rate"] = runsummary[mask]["cosmics_rate"]
-    table["cosmics_rate_10"] = runsummary[mask]["cosmics_rate_above10"]
-    table["cosmics_rate_30"] = runsummary[mask]["cosmics_rate_above30"]
+    table["run_id"] = runs["run_id"]
+    table["cosmics_rate"] = runs["cosmics_rate"]
+    table["cosmics_rate_10"] = runs["cosmics_rate_above10"]
+    table["cosmics_rate_30"] = runs["cosmics_rate_above30"]
     log.info(table)
     table.write(args.output_path, overwrite=True)
 
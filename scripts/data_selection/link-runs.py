@@ -1,16 +1,21 @@
-import json
 import logging
+import os
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from itertools import chain
 from pathlib import Path
 
 from tqdm import tqdm
 
+from scriptutils.catalog import read_runs_by_night
 from scriptutils.link_utils import link
 from scriptutils.log import setup_logging
 
 log = logging.getLogger(__name__)
 
+# DL1 versions in order of preference
+versions = ["v0.9", "v0.10"]
+
 
 def rename_dl1(name):
     """
@@ -20,55 +25,95 @@ def rename_dl1(name):
     return Path(name.strip("dl1_")).with_suffix(".dl1.h5")
 
 
-def main() -> None:  # noqa: PLR-915
+def list_night(template_dir, night, version):
+    """Names of all files of a night, one directory listing instead of a stat per run"""
+    directory = Path(template_dir.format(night=night, version=version))
+    try:
+        return {entry.name for entry in os.scandir(directory)}
+    except FileNotFoundError:
+        log.info(f"{directory} does not exist")
+        return set()
+
+
+def find_targets(template_dir, filename, night, run_ids):
+    """
+    Target of every run of a night, preferring v0.9 over v0.10.
+    Runs without any file are missing from the result.
+    """
+    targets = {}
+    for version in versions:
+        files = list_night(template_dir, night, version)
+        for run_id in run_ids:
+            name = filename.format(run_id=run_id)
+            if run_id not in targets and name in files:
+                directory = template_dir.format(night=night, version=version)
+                targets[run_id] = Path(directory) / name
+    return targets
+
+
+def main() -> None:
     parser = ArgumentParser()
-    parser.add_argument("--runs", required=True)
+    parser.add_argument("--catalog", required=True)
     parser.add_argument("--dl1-link-dir", required=True)
     parser.add_argument("-o", "--output-path", required=True)
+    parser.add_argument("--n-threads", default=8, type=int)
     parser.add_argument("--log-file")
     parser.add_argument("-v", "--verbose", action="store_true")
     args = parser.parse_args()
 
     setup_logging(logfile=args.log_file, verbose=args.verbose)
 
-    with open(args.runs, "r") as f:
-        runs = json.load(f)
+    runs = read_runs_by_night(args.catalog)
     n_runs = len(set(chain(*runs.values())))
     log.info(f"Checking {n_runs} runs")
 
     outdir_dl1 = Path(args.dl1_link_dir)
+    outdir_dl1.mkdir(exist_ok=True, parents=True)
 
     filename_dl1 = "dl1_LST-1.Run{run_id}.h5"
-
-    template_target_dl1 = (
-        Path("/fefs/aswg/data/real/DL1/{night}/{version}/tailcut84") / filename_dl1
-    ).as_posix()
-    log.info(template_target_dl1)
+    template_dir_dl1 = "/fefs/aswg/data/real/DL1/{night}/{version}/tailcut84"
+    log.info(Path(template_dir_dl1) / filename_dl1)
     template_linkname_dl1 = (outdir_dl1 / rename_dl1(filename_dl1)).as_posix()
     log.info(template_linkname_dl1)
 
-    progress = tqdm(total=n_runs)
-    for night, run_ids in runs.items():
-        for run_id in run_ids:
-            log.info(f"Linking for run {run_id}")
-            target_dl1 = Path(template_target_dl1.format(night=night, run_id=run_id, version="v0.9"))
-            linkname_dl1 = Path(
-                template_linkname_dl1.format(
-                    night=night,
-                    run_id=run_id,
-                ),
+    with ThreadPoolExecutor(args.n_threads) as pool:
+        # List every night directory once per version
+        night_targets = pool.map(
+            lambda night: find_targets(
+                template_dir_dl1,
+                filename_dl1,
+                night,
+                runs[night],
+            ),
+            runs,
+        )
+        targets = {}
+        missing = {}
+        for night, found in zip(runs, night_targets):
+            targets.update(found)
+            not_found = [run_id for run_id in runs[night] if run_id not in found]
+            if not_found:
+                missing[night] = not_found
+
+        links = [
+            pool.submit(
+                link,
+                target,
+                Path(template_linkname_dl1.format(run_id=run_id)),
             )
-            if target_dl1.exists():
-                link(target_dl1, linkname_dl1)
-            else:
-                log.info(f"{target_dl1} does not exist")
-                target_dl1 = Path(template_target_dl1.format(night=night, run_id=run_id, version="v0.10"))
-                if target_dl1.exists():
-                    log.info(f"Linking v0.10 for run {run_id}")
-                    link(target_dl1, linkname_dl1)
-                else:
-                    log.warning(f"Could not find either 0.9 or 0.10 for run {run_id}")
-            progress.update()
+            for run_id, target in targets.items()
+        ]
+        for future in tqdm(as_completed(links), total=len(links)):
+            future.result()
+    log.info(f"Linked {len(targets)} of {n_runs} runs")
+
+    if missing:
+        n_missing = sum(len(run_ids) for run_ids in missing.values())
+        log.warning(
+            f"Could not find either {' or '.join(versions)} for {n_missing} runs",
+        )
+        for night, run_ids in missing.items():
+            log.warning(f"Missing runs of night {night}: {run_ids}")
 
     Path(args.output_path).touch()
 
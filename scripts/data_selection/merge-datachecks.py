@@ -1,11 +1,12 @@
 import logging
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from astropy import units as u
-from astropy.table import vstack
+from astropy.table import Table, vstack
 from ctapipe.io import read_table
 from rich.progress import track
 
@@ -13,53 +14,122 @@ from scriptutils.log import setup_logging
 
 log = logging.getLogger(__name__)
 
+template_v09 = (
+    "/fefs/aswg/data/real/OSA/DL1DataCheck_LongTerm/"
+    "v0.9/{night}/DL1_datacheck_{night}.h5"
+)
+template_v10 = (
+    "/fefs/aswg/data/real/OSA/DL1DataCheck_LongTerm/"
+    "v0.10/{night}/DL1_datacheck_{night}.h5"
+)
+# Keys in the metadata of the cached tables identifying the source file
+cache_keys = ("DATACHECK_SOURCE", "DATACHECK_MTIME", "DATACHECK_SIZE")
+
+
+def find_datacheck(night):
+    datacheck_v09 = Path(template_v09.format(night=night))
+    if datacheck_v09.exists():
+        log.debug(f"Adding {datacheck_v09}")
+        return datacheck_v09
+    log.info(f"No v0.9 datacheck found for night {night}. Searching for v0.10")
+    datacheck_v10 = Path(template_v10.format(night=night))
+    if datacheck_v10.exists():
+        log.debug(f"Adding {datacheck_v10}")
+        return datacheck_v10
+    log.warning("%s not found.", night)
+    return None
+
+
+def read_cached_night(cache, night):
+    """The cached runsummary of a night or None"""
+    if cache is None or not cache.exists():
+        return None
+    try:
+        return Table.read(cache, path=f"night_{night}")
+    except OSError:
+        return None
+
+
+def check_night(night, cached):
+    """
+    Datacheck file of one night and its cache key.
+    The cached table is returned as well if the datacheck file did not change.
+    """
+    path = find_datacheck(night)
+    if path is None:
+        return None, None, None
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    if cached is not None and tuple(cached.meta.get(k) for k in cache_keys) == key:
+        log.debug(f"Using cached datacheck of night {night}")
+        return path, key, cached
+    return path, key, None
+
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("input_path")
     parser.add_argument("output_path")
+    parser.add_argument(
+        "--cache",
+        help="Local hdf5 file caching the runsummaries of all nights",
+    )
+    parser.add_argument("--n-threads", default=8, type=int)
     parser.add_argument("--log-file")
     parser.add_argument("-v", "--verbose", action="store_true")
     args = parser.parse_args()
 
-    template_v09 = (
-        "/fefs/aswg/data/real/OSA/DL1DataCheck_LongTerm/"
-        "v0.9/{night}/DL1_datacheck_{night}.h5"
-    )
-    template_v10 = (
-        "/fefs/aswg/data/real/OSA/DL1DataCheck_LongTerm/"
-        "v0.10/{night}/DL1_datacheck_{night}.h5"
-    )
-
     setup_logging(logfile=args.log_file, verbose=args.verbose)
 
     runs = pd.read_csv(args.input_path)
-
-    datachecks = []
-    for night in sorted(np.unique(runs["Date directory"])):
-        datacheck_v09 = template_v09.format(night=night)
-        if Path(datacheck_v09).exists():
-            datachecks.append(datacheck_v09)
-            log.debug(f"Adding {datacheck_v09}")
-        else:
-            log.info(f"No v0.9 datacheck found for noght {night}. Searching for v0.10")
-            datacheck_v10 = template_v10.format(night=night)
-            if Path(datacheck_v10).exists():
-                datachecks.append(datacheck_v10)
-                log.debug(f"Adding {datacheck_v10}")
-            else:
-                log.warning("%s not found.", night)
-    log.info(f"All files: {datachecks}")
-
-    if len(datachecks) == 0:
+    nights = sorted(np.unique(runs["Date directory"]))
+    cache = Path(args.cache) if args.cache is not None else None
+
+    # The cache is local, so read it first. The slow lookups on /fefs
+    # happen concurrently in threads. The hdf5 files are read one after
+    # the other, as the hdf5 library is not thread-safe
+    cached = [read_cached_night(cache, night) for night in nights]
+    with ThreadPoolExecutor(args.n_threads) as pool:
+        checked = list(pool.map(check_night, nights, cached))
+
+    tables = []
+    n_read = 0
+    for night, (path, key, cached_table) in track(
+        zip(nights, checked),
+        total=len(nights),
+        description="Loading datachecks",
+    ):
+        if path is None:
+            continue
+        table = cached_table
+        if table is None:
+            table = read_table(path, "/runsummary/table")
+            table.meta.update(zip(cache_keys, key))
+            n_read += 1
+            if cache is not None:
+                cache.parent.mkdir(exist_ok=True, parents=True)
+                table.write(
+                    cache,
+                    path=f"night_{night}",
+                    serialize_meta=True,
+                    append=True,
+                    overwrite=True,
+                    compression=True,
+                )
+        tables.append(table)
+    log.info(f"Read {n_read} datachecks, {len(tables) - n_read} from the cache")
+    log.info(f"All files: {[t.meta[cache_keys[0]] for t in tables]}")
+
+    if len(tables) == 0:
         raise Exception(
             "No datachecks exist. "
             "That might come from a bad configuration or "
             "means that none are found. "
             "Please check the logs.",
         )
-
-    tables = [read_table(d, "/runsummary/table") for d in track(datachecks)]
+    for table in tables:
+        for key in cache_keys:
+            table.meta.pop(key)
 
     runsummary = vstack(
         tables,
@@ -0,0 +1,299 @@
+"""
+Benchmark the background maker on synthetic DL3 runs.
+This does not need any real data, so it can be run anywhere
+to compare the performance of different versions of scriptutils.bkg.
+"""
+import argparse
+import itertools
+import json
+import logging
+import platform
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import astropy
+import astropy.units as u
+import gammapy
+import numpy as np
+from astropy.coordinates import EarthLocation, SkyCoord
+from astropy.coordinates.erfa_astrom import ErfaAstromInterpolator, erfa_astrom
+from astropy.io import fits
+from astropy.table import Table
+from astropy.time import Time
+from astropy.utils import iers
+from gammapy.data import DataStore
+from gammapy.maps import MapAxis
+from regions import CircleSkyRegion, Regions
+
+from scriptutils.bkg import ExclusionMapBackgroundMaker
+from scriptutils.log import setup_logging
+
+log = logging.getLogger(__name__)
+
+LOCATION = EarthLocation.from_geodetic(-17.89139 * u.deg, 28.76139 * u.deg, 2184 * u.m)
+MJDREF = Time("2019-01-01T00:00:00", scale="utc")
+
+
+def write_synthetic_run(  # noqa: PLR0913
+    path,
+    obs_id,
+    pointing,
+    tstart,
+    duration,
+    n_events,
+    rng,
+    fov_radius=2.5 * u.deg,
+):
+    """
+    Write a DL3 file with an EVENTS and GTI extension.
+    Events are distributed uniformly in the FoV with a power law spectrum.
+    """
+    r = fov_radius * np.sqrt(rng.uniform(0, 1, n_events))
+    phi = rng.uniform(0, 360, n_events) * u.deg
+    radec = pointing.directional_offset_by(phi, r)
+    energy = 0.02 * (1 - rng.uniform(0, 1, n_events)) ** (-1 / 1.7)
+    t0 = (tstart - MJDREF).to_value(u.s)
+    t1 = t0 + duration.to_value(u.s)
+
+    events = Table()
+    events["EVENT_ID"] = np.arange(n_events)
+    events["TIME"] = u.Quantity(np.sort(rng.uniform(t0, t1, n_events)), u.s)
+    events["RA"] = radec.ra.to(u.deg).astype(np.float32)
+    events["DEC"] = radec.dec.to(u.deg).astype(np.float32)
+    events["ENERGY"] = u.Quantity(energy.astype(np.float32), u.TeV)
+    time_meta = {
+        "MJDREFI": int(MJDREF.mjd),
+        "MJDREFF": MJDREF.mjd % 1,
+        "TIMESYS": "UTC",
+        "TIMEUNIT": "s",
+        "TIMEREF": "TOPOCENTER",
+    }
+    events.meta.update(
+        {
+            "EXTNAME": "EVENTS",
+            "HDUCLASS": "GADF",
+            "HDUCLAS1": "EVENTS",
+            "OBS_ID": obs_id,
+            "RA_PNT": pointing.ra.deg,
+            "DEC_PNT": pointing.dec.deg,
+            "TSTART": t0,
+            "TSTOP": t1,
+            "ONTIME": t1 - t0,
+            "LIVETIME": 0.9 * (t1 - t0),
+            "DEADC": 0.9,
+            "GEOLON": LOCATION.lon.deg,
+            "GEOLAT": LOCATION.lat.deg,
+            "ALTITUDE": LOCATION.height.to_value(u.m),
+            "OBS_MODE": "POINTING",
+            "TELESCOP": "CTA-N",
+            "INSTRUME": "LST-1",
+            "RADECSYS": "ICRS",
+            "EQUINOX": 2000.0,
+            **time_meta,
+        },
+    )
+    gti = Table({"START": [t0] * u.s, "STOP": [t1] * u.s})
+    gti.meta.update(
+        {"EXTNAME": "GTI", "HDUCLASS": "GADF", "HDUCLAS1": "GTI", **time_meta},
+    )
+    fits.HDUList(
+        [fits.PrimaryHDU(), fits.table_to_hdu(events), fits.table_to_hdu(gti)],
+    ).writeto(path, overwrite=True)
+    return path
+
+
+def create_synthetic_data(directory, args, rng):
+    """
+    Write the synthetic runs (wobbling around the source) and
+    return them as DataStore together with the exclusion regions.
+    """
+    source = SkyCoord(args.source_ra, args.source_dec, unit="deg")
+    tstart = Time(args.tstart)
+    paths = []
+    for i in range(args.n_runs):
+        # Usual four wobble positions
+        pointing = source.directional_offset_by(90 * (i % 4) * u.deg, args.wobble)
+        paths.append(
+            write_synthetic_run(
+                directory / f"dl3_{i:05d}.fits",
+                obs_id=i + 1,
+                pointing=pointing,
+                tstart=tstart + i * (args.duration + 60 * u.s),
+                duration=args.duration,
+                n_events=args.n_events,
+                rng=rng,
+            ),
+        )
+    regions = [CircleSkyRegion(source, args.exclusion_radius)]
+    # Additional small regions (e.g. stars) somewhere in the FoV
+    stars = source.directional_offset_by(
+        rng.uniform(0, 360, args.n_extra_regions) * u.deg,
+        rng.uniform(0.5, 1.5, args.n_extra_regions) * u.deg,
+    )
+    regions += [CircleSkyRegion(star, 0.1 * u.deg) for star in stars]
+    return DataStore.from_events_files(paths), Regions(regions)
+
+
+def profile(function, *args, repeat=1):
+    """Wall times of all repetitions and the peak memory of the first call"""
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - t0)
+    return result, {
+        "time": times,
+        "time_min": min(times),
+        "time_median": float(np.median(times)),
+        "peak_memory_mb": peak / 1e6,
+    }
+
+
+def benchmark(  # noqa: PLR0913
+    data_store,
+    exclusion_regions,
+    nbins,
+    n_energy_bins,
+    n_time_bins,
+    args,
+):
+    e_reco = MapAxis.from_energy_bounds(
+        20 * u.GeV,
+        20 * u.TeV,
+        n_energy_bins,
+        name="energy",
+    )
+
+    def new_maker():
+        return ExclusionMapBackgroundMaker(
+            e_reco,
+            LOCATION,
+            exclusion_regions=exclusion_regions,
+            nbins=nbins,
+            n_offset_bins=10,
+            n_time_bins=n_time_bins,
+            offset_max=args.offset_max,
+        )
+
+    bkg_maker = new_maker()
+    obs = data_store.obs(data_store.obs_ids[0], required_irf=[])
+    results = {}
+    # obs.events reads the file on every access, so reading is timed on its own
+    # and the maps are filled from a copy of the observation in memory
+    _, results["read_events"] = profile(lambda: obs.events, repeat=args.repeat)
+    obs = obs.copy(in_memory=True)
+    _, results["_fill_counts"] = profile(
+        bkg_maker._fill_counts,
+        obs,
+        repeat=args.repeat,
+    )
+    _, results["_fill_time_maps"] = profile(
+        bkg_maker._fill_time_maps,
+        obs,
+        repeat=args.repeat,
+    )
+    # run accumulates, so every call needs a new maker
+    _, results["run"] = profile(
+        lambda: new_maker().run(data_store),
+        repeat=args.repeat,
+    )
+    bkg_maker.run(data_store)
+    _, results["get_bg_2d"] = profile(bkg_maker.get_bg_2d, repeat=args.repeat)
+    _, results["get_bg_3d"] = profile(bkg_maker.get_bg_3d, repeat=args.repeat)
+    return [
+        {
+            "function": function,
+            "nbins": nbins,
+            "n_energy_bins": n_energy_bins,
+            "n_time_bins": n_time_bins,
+            **result,
+        }
+        for function, result in results.items()
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", required=True, help="json file for the results")
+    parser.add_argument("--nbins", nargs="+", type=int, default=[40, 100, 400])
+    parser.add_argument("--n-energy-bins", nargs="+", type=int, default=[15])
+    parser.add_argument("--n-time-bins", nargs="+", type=int, default=[5])
+    parser.add_argument("--n-runs", type=int, default=3)
+    parser.add_argument("--n-events", type=int, default=100000)
+    parser.add_argument("--duration", type=u.Quantity, default="20 min")
+    parser.add_argument("--tstart", default="2022-01-15T23:00")
+    parser.add_argument("--source-ra", type=float, default=83.633)
+    parser.add_argument("--source-dec", type=float, default=22.014)
+    parser.add_argument("--wobble", type=u.Quantity, default="0.4 deg")
+    parser.add_argument("--exclusion-radius", type=u.Quantity, default="0.3 deg")
+    parser.add_argument("--n-extra-regions", type=int, default=0)
+    parser.add_argument("--offset-max", type=u.Quantity, default="2 deg")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", help="Keep the synthetic runs in this directory")
+    parser.add_argument("--log-file")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    setup_logging(logfile=args.log_file, verbose=args.verbose)
+
+    # Same as in the background scripts.
+    # The synthetic runs do not need the latest earth orientation parameters
+    erfa_astrom.set(ErfaAstromInterpolator(300 * u.s))
+    iers.conf.auto_download = False
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(args.data_dir or tmp)
+        directory.mkdir(exist_ok=True, parents=True)
+        data_store, exclusion_regions = create_synthetic_data(directory, args, rng)
+
+        results = []
+        for nbins, n_energy_bins, n_time_bins in itertools.product(
+            args.nbins,
+            args.n_energy_bins,
+            args.n_time_bins,
+        ):
+            log.info(
+                f"Benchmarking nbins={nbins}, n_energy_bins={n_energy_bins}, "
+                f"n_time_bins={n_time_bins}",
+            )
+            new = benchmark(
+                data_store,
+                exclusion_regions,
+                nbins,
+                n_energy_bins,
+                n_time_bins,
+                args,
+            )
+            results += new
+            for result in new:
+                log.info(
+                    f"{result['function']}: {result['time_min']:.3f} s, "
+                    f"{result['peak_memory_mb']:.1f} MB",
+                )
+
+    output = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "astropy": astropy.__version__,
+            "gammapy": gammapy.__version__,
+            "arguments": {key: str(value) for key, value in vars(args).items()},
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
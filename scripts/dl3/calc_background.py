@@ -1,22 +1,32 @@
 # Code for bkgmodel adapted from Simone Mender
 # https://github.com/cta-observatory/pybkgmodel/tree/add_exlcusion_region_method
 import argparse
+import json
 import logging
-import pickle
+import shutil
+from copy import deepcopy
+from os.path import relpath
 from pathlib import Path
 
 import astropy.units as u
 import numpy as np
 import pandas as pd
 import yaml
-from astropy.coordinates import EarthLocation
+from astropy.coordinates import AltAz, EarthLocation, SkyCoord
 from astropy.coordinates.erfa_astrom import ErfaAstromInterpolator, erfa_astrom
+from astropy.time import Time
 from gammapy.data import DataStore
 from gammapy.maps import MapAxis
 from regions import Regions
 
-from scriptutils.bkg import ExclusionMapBackgroundMaker
+from scriptutils.bkg import ExclusionMapBackgroundMaker, read_cached_maps
 from scriptutils.log import setup_logging
+from scriptutils.matching import (
+    check_nodes,
+    find_nearest_runs,
+    grid_interpolation_weights,
+    scaled_features,
+)
 
 log = logging.getLogger(__name__)
 
@@ -33,6 +43,10 @@ def main():  # noqa
     parser.add_argument("--output-dir", required=True)
     parser.add_argument("--output-prefix", default="bkg")
     parser.add_argument("--dummy-output", required=True)
+    parser.add_argument(
+        "--output-mapping",
+        help="json file mapping every obs_id to its bkg file",
+    )
     parser.add_argument("--overwrite", action="store_true")
     parser.add_argument("--log-file")
     parser.add_argument("-v", "--verbose", action="store_true")
@@ -48,6 +62,13 @@ def main():  # noqa
     e_binning = config["binning"]["energy"]
     fov_binning = config["binning"]["offset"]
     gaussian_smoothing_3d = config.get("gaussian_smoothing_3d")
+    # Merge pixels with few counts in the 3D model, e.g. {min_counts: 10}
+    adaptive_binning = config.get("adaptive_binning", {})
+    # Write only one file per model instead of one per run.
+    # The runs are linked to the shared files through the mapping
+    deduplicate_files = config.get("deduplicate_files", False)
+    # Keep the per-run counts in memory as compact (e.g. float32) arrays
+    counts_dtype = config.get("counts_dtype")
     matching = config["run_matching"]
     assert len(matching) == 1, "Got more than one matching key in config"
     match_on = list(matching.keys())[0]
@@ -63,66 +84,48 @@ def main():  # noqa
         name="energy",
     )
     ds = DataStore.from_events_files(args.input_runs)
-    with open(args.cached_maps, "rb") as f:
-        cached_maps = pickle.load(f)
+    cached_maps = read_cached_maps(
+        args.cached_maps,
+        ds.obs_ids,
+        counts_dtype=counts_dtype,
+    )
 
-    # Select similar runs. This is only zenith right now
+    # Select similar runs. This is only zenith right now, except for nearest_runs
     # Ra/dec is assumed to be correclty incorporated earlier
     # Az is neglected for now, maybe thats fine for one LST
     # Time is neglected as well. Very different runs should be excluded before this
     # and there is no notion of MC-periods in LST so far
 
     # looks like obs_table isbehaving inconsistenly
-    zens = []
-    decs = []
+    pointings = []
+    tmids = []
+    livetimes = []
     # TODO Define somewhere and import
     location = EarthLocation.of_site("Roque de los Muchachos")
     for obs_id in ds.obs_ids:
         obs = ds.obs(obs_id)
-        decs.append(obs.pointing.get_icrs().dec.deg)
-        zens.append(
-            90 - obs.pointing.get_altaz(location=location, obstime=obs.tmid).alt.deg,
-        )
+        pointings.append(obs.pointing.get_icrs())
+        tmids.append(obs.tmid)
+        livetimes.append(obs.observation_live_time_duration.to_value(u.h))
+    # One transformation for all runs
+    tmids = Time(tmids)
+    altaz = SkyCoord(pointings).transform_to(AltAz(obstime=tmids, location=location))
+    zens = 90 - altaz.alt.deg
     criteria = pd.DataFrame(
         {
             "obs_id": ds.obs_ids,
             "zenith": zens,
             "cos_zenith": np.cos(np.deg2rad(zens)),
+            "azimuth": altaz.az.deg,
+            "date": tmids.mjd,
+            "livetime": livetimes,
         },
     )
 
     log.info(f"Selection criteria: {criteria}")
 
-    for i, obs_id in enumerate(ds.obs_ids):
-        if match_on == "max_cos_zenith_diff":
-            cos_zenith_diff = np.abs(
-                (criteria["cos_zenith"] - criteria["cos_zenith"][i]).values,
-            )
-            mask = cos_zenith_diff < matching["max_cos_zenith_diff"]
-            selected_ids = criteria["obs_id"][mask].values
-        elif match_on == "zenith_bin_edges":
-            # this is a bit of a waste creating the bins and indices for every obs...
-            edges = matching["zenith_bin_edges"]
-            # Select all runs ending up in the same bin
-            idx = np.digitize(criteria["zenith"], edges)
-            mask = idx == idx[i]
-            selected_ids = criteria["obs_id"][mask].values
-        elif match_on == "cos_zenith_bin_edges":
-            # this is a bit of a waste creating the bins and indices for every obs...
-            edges = matching["cos_zenith_bin_edges"]
-            # Select all runs ending up in the same bin
-            idx = np.digitize(criteria["cos_zenith"], edges)
-            mask = idx == idx[i]
-            selected_ids = criteria["obs_id"][mask].values
-        # TODO n_zenith_bins? then I have bins with the same amount of runs...
-        else:
-            raise NotImplementedError()
-
-        log.info(f"Selected to match {obs_id}: {len(selected_ids)} ({selected_ids})")
-        log.info(f"Selected to match {criteria[mask]}")
-
-        # select fitting runs
-        bkg_maker = ExclusionMapBackgroundMaker(
+    def new_bkg_maker():
+        return ExclusionMapBackgroundMaker(
             e_reco,
             location,
             exclusion_regions=exclusion_regions,
@@ -130,18 +133,193 @@ def main():  # noqa
             n_offset_bins=fov_binning.get("n_offset_bins", 8),
             offset_max=u.Quantity(fov_binning["max"]),
             gaussian_smoothing_3d=gaussian_smoothing_3d,
+            adaptive_min_counts=adaptive_binning.get("min_counts"),
+            adaptive_max_level=adaptive_binning.get("max_level", 4),
         )
-        bkg_maker.run(ds, selected_ids, cached_maps=cached_maps)
+
+    bkg_files = {}
+
+    def get_background(bkg_maker, resample_factor=None):
         if config["hdu_type"] == "3D":
-            bkg = bkg_maker.get_bg_3d()
-        elif config["hdu_type"] == "2D":
-            bkg = bkg_maker.get_bg_2d()
+            return bkg_maker.get_bg_3d(resample_factor=resample_factor)
+        if config["hdu_type"] == "2D":
+            return bkg_maker.get_bg_2d()
+        raise NotImplementedError()
+
+    def write_background(bkg, obs_ids):
+        """Write the model once and copy or link it for all other runs sharing it"""
+        paths = [out / f"{config['prefix']}_{obs_id:05d}.fits.gz" for obs_id in obs_ids]
+        bkg.write(paths[0], overwrite=args.overwrite)
+        for obs_id, path in zip(obs_ids, paths):
+            if deduplicate_files:
+                bkg_files[obs_id] = paths[0]
+            else:
+                if path != paths[0]:
+                    shutil.copyfile(paths[0], path)
+                bkg_files[obs_id] = path
+
+    # Runs with identical selections get the same model,
+    # so every model is calculated only once
+    if match_on == "max_cos_zenith_diff":
+        # After sorting by cos zenith, the runs matching a run form a window.
+        # Windows only move forward, so going from one to the next
+        # only adds the runs entering and removes the runs leaving the window
+        order = np.argsort(criteria["cos_zenith"].values, kind="stable")
+        cos_zenith = criteria["cos_zenith"].values[order]
+        sorted_ids = criteria["obs_id"].values[order]
+        max_diff = matching["max_cos_zenith_diff"]
+        lower = np.searchsorted(cos_zenith, cos_zenith - max_diff, side="right")
+        upper = np.searchsorted(cos_zenith, cos_zenith + max_diff, side="left")
+        windows = {}
+        for obs_id, window in zip(sorted_ids, zip(lower, upper)):
+            windows.setdefault(window, []).append(obs_id)
+
+        bkg_maker = new_bkg_maker()
+        current_lower, current_upper = 0, 0
+        for (window_lower, window_upper), obs_ids in windows.items():
+            bkg_maker.add_maps(cached_maps, sorted_ids[current_upper:window_upper])
+            bkg_maker.remove_maps(cached_maps, sorted_ids[current_lower:window_lower])
+            current_lower, current_upper = window_lower, window_upper
+
+            selected_ids = sorted_ids[window_lower:window_upper]
+            log.info(
+                f"Selected to match {obs_ids}: {len(selected_ids)} ({selected_ids})",
+            )
+            bkg_maker.finalize()
+            write_background(get_background(bkg_maker), obs_ids)
+    elif match_on in ("zenith_bin_edges", "cos_zenith_bin_edges"):
+        # Select all runs ending up in the same bin
+        edges = matching[match_on]
+        idx = np.digitize(criteria[match_on.replace("_bin_edges", "")], edges)
+        for i in np.unique(idx):
+            mask = idx == i
+            selected_ids = criteria["obs_id"][mask].values
+            log.info(f"Selected to match bin {i}: {len(selected_ids)} ({selected_ids})")
+            log.info(f"Selected to match {criteria[mask]}")
+
+            bkg_maker = new_bkg_maker()
+            bkg_maker.run(ds, selected_ids, cached_maps=cached_maps)
+            write_background(get_background(bkg_maker), selected_ids)
+    elif match_on == "nearest_runs":
+        # Select the closest runs in the space of the criteria listed in "scales",
+        # each divided by its scale, see scaled_features
+        nearest = matching[match_on]
+        columns = {
+            # Other columns of the observation table can be used, e.g. the NSB level
+            name: criteria[name].values
+            if name in criteria
+            else np.asarray(ds.obs_table[name])
+            for name in nearest["scales"]
+        }
+        neighbours = find_nearest_runs(
+            scaled_features(columns, nearest["scales"]),
+            criteria["livetime"].values,
+            nearest["n_runs"],
+            u.Quantity(nearest.get("min_livetime", "0 h")).to_value(u.h),
+        )
+        # Runs with the same neighbours share one model
+        models = {}
+        for obs_id, idx in zip(criteria["obs_id"].values, neighbours):
+            models.setdefault(idx, []).append(obs_id)
+        log.info(f"Calculating {len(models)} models for {len(criteria)} runs")
+
+        # Only add and remove the runs differing from the previous model
+        bkg_maker = new_bkg_maker()
+        current = set()
+        for idx, obs_ids in models.items():
+            selected = set(criteria["obs_id"].values[list(idx)])
+            bkg_maker.add_maps(cached_maps, sorted(selected - current))
+            bkg_maker.remove_maps(cached_maps, sorted(current - selected))
+            current = selected
+            log.info(
+                f"Selected to match {obs_ids}: {len(selected)} ({sorted(selected)})",
+            )
+            bkg_maker.finalize()
+            write_background(get_background(bkg_maker), obs_ids)
+    elif match_on == "cos_zenith_grid":
+        # Models are only calculated on a grid of nodes and interpolated
+        # to the pointing of every run, similar to the irf interpolation
+        grid = matching[match_on]
+        cz_nodes = check_nodes(grid["cos_zenith_nodes"], "cos_zenith_nodes")
+        if "max_cos_zenith_diff" in grid:
+            cz_max_diff = grid["max_cos_zenith_diff"]
+        elif len(cz_nodes) > 1:
+            # Half of the largest node spacing, so every run is close to a node
+            cz_max_diff = np.diff(cz_nodes).max() / 2
         else:
-            raise NotImplementedError()
-        bkg.write(
-            out / f"{config['prefix']}_{obs_id:05d}.fits.gz",
-            overwrite=args.overwrite,
+            raise ValueError("max_cos_zenith_diff is required for a single node")
+        # Without azimuth nodes, a single node covers all azimuths
+        az_nodes = check_nodes(grid.get("azimuth_nodes", [0]), "azimuth_nodes", 360)
+        az_max_diff = grid.get("max_azimuth_diff", 180)
+        cos_zenith = criteria["cos_zenith"].values
+        azimuth = criteria["azimuth"].values
+
+        node_makers = {}
+        for i, cz_node in enumerate(cz_nodes):
+            for j, az_node in enumerate(az_nodes):
+                az_diff = np.abs((azimuth - az_node + 180) % 360 - 180)
+                mask = (np.abs(cos_zenith - cz_node) <= cz_max_diff) & (
+                    az_diff <= az_max_diff
+                )
+                selected_ids = criteria["obs_id"].values[mask]
+                log.info(
+                    f"Node cos zenith {cz_node}, azimuth {az_node}: "
+                    f"{len(selected_ids)} runs ({selected_ids})",
+                )
+                if len(selected_ids) == 0:
+                    continue
+                bkg_maker = new_bkg_maker()
+                bkg_maker.run(ds, selected_ids, cached_maps=cached_maps)
+                node_makers[i, j] = bkg_maker
+        if not node_makers:
+            raise ValueError("No runs close to any of the grid nodes")
+
+        # The blended models need the same spatial binning, so with adaptive
+        # binning all nodes are resampled to the finest one of them
+        resample_factor = None
+        if config["hdu_type"] == "3D":
+            resample_factor = min(
+                maker.adaptive_resample_factor() for maker in node_makers.values()
+            )
+        node_models = {
+            node: get_background(maker, resample_factor)
+            for node, maker in node_makers.items()
+        }
+        del node_makers
+
+        # Runs with the same interpolation weights share one model
+        models = {}
+        for obs_id, cz, az in zip(criteria["obs_id"].values, cos_zenith, azimuth):
+            weights = grid_interpolation_weights(
+                node_models.keys(),
+                cz,
+                az,
+                cz_nodes,
+                az_nodes,
+            )
+            models.setdefault(tuple(sorted(weights.items())), []).append(obs_id)
+        log.info(
+            f"Interpolating {len(models)} models from {len(node_models)} nodes",
         )
+        for weights, obs_ids in models.items():
+            log.info(f"Weights for {obs_ids}: {weights}")
+            bkg = deepcopy(node_models[weights[0][0]])
+            bkg.quantity = sum(w * node_models[node].quantity for node, w in weights)
+            write_background(bkg, obs_ids)
+    # TODO n_zenith_bins? then I have bins with the same amount of runs...
+    else:
+        raise NotImplementedError()
+    if args.output_mapping is not None:
+        mapping_path = Path(args.output_mapping)
+        with open(mapping_path, "w") as f:
+            json.dump(
+                {
+                    str(obs_id): relpath(path, mapping_path.parent)
+                    for obs_id, path in sorted(bkg_files.items())
+                },
+                f,
+                indent=2,
+            )
     Path(args.dummy_output).touch()
 
 
@@ -1,19 +1,18 @@
 import logging
 from argparse import ArgumentParser
+from os.path import relpath
 from pathlib import Path
 
 import numpy as np
-from astropy.table import Table
 from astropy.io import fits
-from os.path import relpath
+from astropy.table import Table
 
-log = logging.getLogger(__name__)
+from scriptutils.bkg import read_bkg_mapping
 
+log = logging.getLogger(__name__)
 
-def main(hdu_index_path, bkg_files):
-    t = Table.read(hdu_index_path)
-    ids = sorted(np.unique(t["OBS_ID"]))
 
+def match_bkg_files(ids, bkg_files):
     if len(bkg_files) == 1:
         bkg_files = bkg_files * len(ids)
     elif len(bkg_files) == len(ids):
@@ -31,31 +30,49 @@ def main(hdu_index_path, bkg_files):
             We have {len(ids)} obs,
             but {len(bkg_files)} bkg files""",
         )
+    return dict(zip(ids, bkg_files))
+
+
+def main(hdu_index_path, bkg_files=None, bkg_mapping=None):
+    t = Table.read(hdu_index_path)
+    ids = sorted(np.unique(t["OBS_ID"]))
+
+    if bkg_mapping is not None:
+        # Several runs can share the same file here
+        bkg_files = read_bkg_mapping(bkg_mapping)
+    else:
+        bkg_files = match_bkg_files(ids, bkg_files)
+
     # remove old links in case of reexecution of bkg rules
     t.remove_rows(np.nonzero(t["HDU_TYPE"] == "bkg"))
-    for i, b in zip(ids, bkg_files):
-        bkg = Path(b)
+    # Every file only needs to be opened once
+    hdu_classes = {}
+    for i in ids:
+        bkg = Path(bkg_files[i])
         log.info(f"Linking {bkg} to obs id {i}")
-        with fits.open(bkg) as f:
-            t.add_row(
-                [
-                    i,
-                    "bkg",
-                    f[1].header['HDUCLAS4'].lower(),
-                    relpath(bkg.parent, hdu_index_path.parent),
-                    bkg.name,
-                    "BACKGROUND",
-                    -1,
-                ],
-            )
-        log.info(t)
+        if bkg not in hdu_classes:
+            hdu_classes[bkg] = fits.getval(bkg, "HDUCLAS4", ext=1).lower()
+        t.add_row(
+            [
+                i,
+                "bkg",
+                hdu_classes[bkg],
+                relpath(bkg.parent, hdu_index_path.parent),
+                bkg.name,
+                "BACKGROUND",
+                -1,
+            ],
+        )
+    log.info(t)
     t.write(hdu_index_path, overwrite=True)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--hdu-index-path", required=True)
-    parser.add_argument("--bkg-files", required=True, nargs="+")
+    bkg = parser.add_mutually_exclusive_group(required=True)
+    bkg.add_argument("--bkg-files", nargs="+")
+    bkg.add_argument("--bkg-mapping", help="json file mapping obs_ids to bkg files")
     parser.add_argument("--log-file")
     parser.add_argument(
         "-v",
@@ -63,4 +80,8 @@ if __name__ == "__main__":
         action="store_true",
     )  # TODO setup logging without scriptutils...
     args = parser.parse_args()
-    main(Path(args.hdu_index_path), args.bkg_files)
+    main(
+        Path(args.hdu_index_path),
+        bkg_files=args.bkg_files,
+        bkg_mapping=Path(args.bkg_mapping) if args.bkg_mapping else None,
+    )
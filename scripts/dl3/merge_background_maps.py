@@ -0,0 +1,34 @@
+import argparse
+import logging
+
+from scriptutils.bkg import read_run_obs_id, write_cached_maps_index
+from scriptutils.log import setup_logging
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    """
+    Collect the per-run maps written by precompute_background_maps.py --output-maps
+    in the index read by calc_background.py.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-maps", required=True, nargs="+")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--log-file")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    setup_logging(logfile=args.log_file, verbose=args.verbose)
+
+    run_files = {}
+    for path in args.input_maps:
+        obs_id = read_run_obs_id(path)
+        if obs_id in run_files:
+            raise ValueError(f"Got maps for obs {obs_id} twice")
+        run_files[obs_id] = path
+    log.info(f"Collected maps of {len(run_files)} runs")
+    write_cached_maps_index(args.output, run_files)
+
+
+if __name__ == "__main__":
+    main()
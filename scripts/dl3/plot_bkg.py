@@ -7,6 +7,7 @@ import numpy as np
 from gammapy.irf import Background2D, Background3D
 from matplotlib import pyplot as plt
 
+from scriptutils.bkg import read_bkg_mapping
 from scriptutils.log import setup_logging
 
 if matplotlib.get_backend() == "pgf":
@@ -154,11 +155,24 @@ def main(input_path, output):
 
 if __name__ == "__main__":
     parser = ArgumentParser()
-    parser.add_argument("-i", "--input-path", required=True)
+    bkg = parser.add_mutually_exclusive_group(required=True)
+    bkg.add_argument("-i", "--input-path")
+    bkg.add_argument("--bkg-mapping", help="json file mapping obs_ids to bkg files")
+    parser.add_argument("--obs-id", type=int, help="Required with --bkg-mapping")
     parser.add_argument("-o", "--output", required=True)
     parser.add_argument("--log-file")
     parser.add_argument("-v", "--verbose", action="store_true")
     args = parser.parse_args()
+    if args.bkg_mapping is not None and args.obs_id is None:
+        parser.error("--obs-id is required with --bkg-mapping")
     setup_logging(logfile=args.log_file, verbose=args.verbose)
 
-    main(args.input_path, args.output)
+    input_path = args.input_path
+    if args.bkg_mapping is not None:
+        # Several runs might share the same file
+        bkg_files = read_bkg_mapping(args.bkg_mapping)
+        if args.obs_id not in bkg_files:
+            parser.error(f"obs_id {args.obs_id} is not in {args.bkg_mapping}")
+        input_path = bkg_files[args.obs_id]
+
+    main(input_path, args.output)
@@ -2,8 +2,8 @@
 # https://github.com/cta-observatory/pybkgmodel/tree/add_exlcusion_region_method
 import argparse
 import logging
-import pickle
 import warnings
+
 import astropy.units as u
 import yaml
 from astropy.coordinates import EarthLocation
@@ -13,7 +13,7 @@ from gammapy.maps import MapAxis
 from gammapy.utils.deprecation import GammapyDeprecationWarning
 from regions import Regions
 
-from scriptutils.bkg import ExclusionMapBackgroundMaker
+from scriptutils.bkg import ExclusionMapBackgroundMaker, write_run_maps
 from scriptutils.log import setup_logging
 
 log = logging.getLogger(__name__)
@@ -24,11 +24,14 @@ def main():
     Function running the entire background reconstruction procedure.
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input-runs", required=True, nargs="+")
+    parser.add_argument("--input-run", required=True)
     parser.add_argument("--config", required=True)
     parser.add_argument("--exclusion", required=True)
-    parser.add_argument("--output", required=True)
-    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument(
+        "--output-maps",
+        required=True,
+        help="File for the maps of the run, see merge_background_maps.py",
+    )
     parser.add_argument("--log-file")
     parser.add_argument("-v", "--verbose", action="store_true")
     args = parser.parse_args()
@@ -38,10 +41,21 @@ def main():
 
     with open(args.config) as f:
         config = yaml.safe_load(f)
-    e_binning = config["binning"]["energy"]
-    fov_binning = config["binning"]["offset"]
     exclusion_regions = Regions.read(args.exclusion, format="ds9")
 
+    # One job per run, the runs get assembled by merge_background_maps.py
+    fill_and_write_maps(
+        args.input_run,
+        args.output_maps,
+        config,
+        exclusion_regions,
+    )
+
+
+def fill_and_write_maps(path, output_path, config, exclusion_regions):
+    """Fill the maps of the run in `path` and write them to `output_path`"""
+    e_binning = config["binning"]["energy"]
+    fov_binning = config["binning"]["offset"]
     # TODO Define that properly somewhere
     location = EarthLocation.of_site("Roque de los Muchachos")
     e_reco = MapAxis.from_energy_bounds(
@@ -51,18 +65,30 @@ def main():
         name="energy",
     )
 
-    ds = DataStore.from_events_files(args.input_runs)
+    ds = DataStore.from_events_files([path])
     bkg_maker = ExclusionMapBackgroundMaker(
         e_reco,
         location,
         exclusion_regions=exclusion_regions,
         nbins=fov_binning["n_bins"],
         n_offset_bins=fov_binning.get("n_offset_bins", 8),
+        n_time_bins=fov_binning.get("n_time_bins", 5),
+        time_bin_tolerance=fov_binning.get("time_bin_tolerance"),
+        max_n_time_bins=fov_binning.get("max_n_time_bins", 100),
+        time_batch_size=fov_binning.get("time_batch_size", 4),
         offset_max=u.Quantity(fov_binning["max"]),
+        exclusion_binsz=fov_binning.get("exclusion_binsz", "0.01 deg"),
     )
     cached_maps = bkg_maker._fill_all_maps(ds, None)
-    with open(args.output, "wb") as f:
-        pickle.dump(cached_maps, f)
+    (obs_id,) = cached_maps["counts_obs"]
+    write_run_maps(
+        output_path,
+        cached_maps["counts_eff"][obs_id],
+        cached_maps["counts_obs"][obs_id],
+        cached_maps["times_eff"][obs_id],
+        cached_maps["times_obs"][obs_id],
+        obs_id=obs_id,
+    )
 
 
 if __name__ == "__main__":
@@ -1,13 +1,18 @@
+import json
 import logging
+from os.path import relpath
+from pathlib import Path
 
 import astropy.units as u
 import numpy as np
-from astropy.convolution import Gaussian2DKernel, convolve
-from astropy.coordinates import AltAz, Angle, SkyCoord
+from astropy.convolution import Gaussian2DKernel, convolve_fft
+from astropy.coordinates import Angle, SkyCoord
 from astropy.time import Time
 from gammapy.irf import Background2D, Background3D, FoVAlignment
 from gammapy.maps import MapAxis, RegionGeom
-from gammapy.utils.coordinates import fov_to_sky, sky_to_fov
+from scipy.ndimage import binary_dilation, binary_erosion
+
+from scriptutils.pointing import AltAzTransformCache, fov_to_sky, sky_to_fov
 
 log = logging.getLogger(__name__)
 
@@ -47,6 +52,362 @@ def cone_solid_angle_rectangular_pyramid(a, b):
     return solid_angle
 
 
+def smooth_fov_maps(maps, stddev):
+    """
+    Smooth all energy slices of a (energy, lon, lat) quantity with
+    a gaussian kernel in a single fft convolution.
+    Gives the same result as convolving each slice with
+    astropy.convolution.convolve: nans are interpolated
+    and pixels next to infs (counts, but zero exposure) become inf.
+    """
+    kernel = Gaussian2DKernel(stddev).array[np.newaxis]
+    values = maps.to_value(maps.unit)
+    inf = np.isinf(values)
+    smoothed = convolve_fft(
+        np.where(inf, 0, values),
+        kernel,
+        boundary="fill",
+        fill_value=0,
+        nan_treatment="interpolate",
+        normalize_kernel=True,
+    )
+    if inf.any():
+        # Direct convolution propagates infs to the full kernel footprint
+        footprint = convolve_fft(
+            inf.astype(float),
+            (kernel != 0).astype(float),
+            normalize_kernel=False,
+        )
+        smoothed[footprint.round().astype(bool)] = np.inf
+    # The fft leaves tiny negative values where the rates are zero
+    if np.all(values[~np.isnan(values)] >= 0):
+        np.clip(smoothed, 0, None, out=smoothed)
+    return u.Quantity(smoothed, maps.unit, copy=False)
+
+
+class RasterizedExclusion:
+    """
+    Exclusion regions rasterized once on a fine wcs grid.
+    Lookups are a pixel index into the rasterized masks.
+    Points falling into pixels close to a region border
+    are checked exactly against the region.
+    This uses the same projection as ``RegionGeom.from_regions(regions)``,
+    so the results are the same as for ``RegionGeom.contains``.
+
+    Parameters
+    ----------
+    regions: regions.Regions or list of regions.SkyRegion
+        The exclusion regions.
+    binsz: astropy.units.Quantity or str
+        Pixel size of the rasterized masks.
+        Needs to be small compared to the regions.
+    """
+
+    def __init__(self, regions, binsz="0.01 deg"):
+        self.binsz = u.Quantity(binsz).to_value(u.deg)
+        self.wcs = RegionGeom.from_regions(regions).wcs.deepcopy()
+        self.wcs.wcs.cdelt = [-self.binsz, self.binsz]
+        self.wcs.wcs.crpix = [0, 0]
+        margin = 4
+        self.rasters = []
+        for region in regions:
+            bbox = region.to_pixel(self.wcs).bounding_box
+            offset = np.array([bbox.ixmin - margin, bbox.iymin - margin])
+            shape = (bbox.shape[0] + 2 * margin, bbox.shape[1] + 2 * margin)
+            y, x = np.indices(shape)
+            pixels = SkyCoord.from_pixel(x + offset[0], y + offset[1], self.wcs)
+            inside = region.contains(pixels, self.wcs)
+            # Pixels near the border are not decided by the raster alone
+            border = binary_dilation(inside, iterations=2) & ~binary_erosion(
+                inside,
+                iterations=2,
+                border_value=1,
+            )
+            self.rasters.append((region, offset, inside & ~border, border))
+
+    def contains(self, coords):
+        """
+        Check which coordinates are inside any of the regions.
+
+        Parameters
+        ----------
+        coords: astropy.coordinates.SkyCoord
+            Coordinates to check.
+
+        Returns
+        -------
+        mask: numpy.ndarray
+            Boolean array with the shape of ``coords``,
+            true for coordinates inside of the regions.
+        """
+        shape = coords.shape
+        coords = coords.ravel()
+        x, y = coords.to_pixel(self.wcs)
+        result = np.zeros(coords.shape, dtype=bool)
+        for region, offset, inside, border in self.rasters:
+            with np.errstate(invalid="ignore"):
+                ix = np.rint(x - offset[0])
+                iy = np.rint(y - offset[1])
+                on_map = (ix >= 0) & (ix < inside.shape[1])
+                on_map &= (iy >= 0) & (iy < inside.shape[0])
+            idx = np.nonzero(on_map)[0]
+            iy = iy[idx].astype(int)
+            ix = ix[idx].astype(int)
+            result[idx[inside[iy, ix]]] = True
+            check = idx[border[iy, ix]]
+            if len(check) > 0:
+                result[check] |= region.contains(coords[check], self.wcs)
+        return result.reshape(shape)
+
+
+class CompactCounts:
+    """
+    Counts cube of one run (energy, lat, lon) in a compact dtype.
+    Energy slices with only few filled pixels (usually the high energies)
+    are stored as flat pixel indices and values, all others as dense arrays.
+    Each slice uses whichever representation needs less memory.
+
+    Parameters
+    ----------
+    counts: numpy.ndarray
+        Dense counts cube.
+    dtype: numpy.dtype or str
+        dtype of the stored counts, e.g. uint32 or float32.
+    """
+
+    def __init__(self, counts, dtype="float32"):
+        counts = np.asarray(counts)
+        self.shape = counts.shape
+        self.dtype = np.dtype(dtype)
+        index_dtype = np.min_scalar_type(counts[0].size)
+        self.slices = []
+        for counts_slice in counts:
+            flat = counts_slice.ravel()
+            filled = np.flatnonzero(flat)
+            sparse_bytes = len(filled) * (index_dtype.itemsize + self.dtype.itemsize)
+            if sparse_bytes < flat.size * self.dtype.itemsize:
+                self.slices.append(
+                    (filled.astype(index_dtype), flat[filled].astype(self.dtype)),
+                )
+            else:
+                self.slices.append(counts_slice.astype(self.dtype))
+
+    @property
+    def nbytes(self):
+        """Memory used by the stored counts."""
+        return sum(
+            sum(a.nbytes for a in s) if isinstance(s, tuple) else s.nbytes
+            for s in self.slices
+        )
+
+    def to_dense(self):
+        """Return the counts as dense array in the compact dtype."""
+        counts = np.zeros(self.shape, dtype=self.dtype)
+        for target, s in zip(counts, self.slices):
+            if isinstance(s, tuple):
+                target.ravel()[s[0]] = s[1]
+            else:
+                target[:] = s
+        return counts
+
+    def __array__(self, dtype=None):
+        counts = self.to_dense()
+        return counts if dtype is None else counts.astype(dtype)
+
+    def add_to(self, target, sign=1):
+        """
+        Add (sign=1) or subtract (sign=-1) the counts from the dense
+        float array ``target`` in place without creating a dense copy.
+        """
+        op = np.add if sign > 0 else np.subtract
+        for target_slice, s in zip(target, self.slices):
+            if isinstance(s, tuple):
+                # Pixel indices are unique, so fancy indexing is fine
+                flat = target_slice.reshape(-1)
+                flat[s[0]] = op(flat[s[0]], s[1])
+            else:
+                op(target_slice, s, out=target_slice)
+
+
+def _add_counts(target, counts, sign=1):
+    if isinstance(counts, CompactCounts):
+        counts.add_to(target, sign)
+    elif sign > 0:
+        target += counts
+    else:
+        target -= counts
+
+
+def _block_sum(a, size):
+    """Sum the last two axes of `a` in blocks of size x size"""
+    *rest, n_y, n_x = a.shape
+    return a.reshape(*rest, n_y // size, size, n_x // size, size).sum(axis=(-3, -1))
+
+
+def _upsample(a, size):
+    """Repeat every pixel of the last two axes size x size times"""
+    return a.repeat(size, axis=-2).repeat(size, axis=-1)
+
+
+def adaptive_rates(counts, exposure, min_counts, max_level):
+    """
+    Merge low statistics pixels of every energy slice in a quadtree.
+    Starting with blocks of 2**max_level pixels, a block is split into its
+    four children as long as all of them contain at least `min_counts`
+    (children without exposure do not count).
+    Every pixel then gets the rate of the block it ended up in.
+
+    Parameters
+    ----------
+    counts: numpy.ndarray
+        Counts with shape (n_energy, n, n).
+    exposure: numpy.ndarray
+        Exposure (time x solid angle) of the pixels with shape (n, n).
+    min_counts: float
+        Minimum counts needed in each child to split a block.
+    max_level: int
+        Size of the largest blocks as power of 2.
+
+    Returns
+    -------
+    rates: numpy.ndarray
+        counts / exposure with shape (n_energy, n, n),
+        nan for pixels without exposure.
+    levels: numpy.ndarray
+        Size of the block of every pixel as power of 2, shape (n_energy, n, n).
+    """
+    n_energy, n_y, n_x = counts.shape
+    # Pad to full blocks at the coarsest level. The padding has no exposure
+    size = 2**max_level
+    pad = ((0, (-n_y) % size), (0, (-n_x) % size))
+    exposure = np.pad(exposure, pad)
+    counts = np.pad(np.where(exposure[:n_y, :n_x] > 0, counts, 0), ((0, 0), *pad))
+    block_counts = [counts]
+    block_exposure = [exposure]
+    for _ in range(max_level):
+        block_counts.append(_block_sum(block_counts[-1], 2))
+        block_exposure.append(_block_sum(block_exposure[-1], 2))
+
+    # Going from the coarsest to the finest blocks,
+    # levels holds the final level of every block
+    levels = np.full(block_counts[-1].shape, max_level)
+    for level in range(max_level, 0, -1):
+        children = (block_counts[level - 1] >= min_counts) | (
+            block_exposure[level - 1] == 0
+        )
+        # Split only if all four children have enough counts
+        n_children = 4
+        split = (levels == level) & (_block_sum(children, 2) == n_children)
+        levels = _upsample(levels, 2)
+        levels[_upsample(split, 2)] = level - 1
+
+    rates = np.full(counts.shape, np.nan)
+    for level, (c, e) in enumerate(zip(block_counts, block_exposure)):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rate = _upsample(c / np.where(e > 0, e, np.nan), 2**level)
+        mask = levels == level
+        rates[mask] = rate[mask]
+    rates[:, exposure == 0] = np.nan
+    return rates[:, :n_y, :n_x], levels[:, :n_y, :n_x]
+
+
+def write_run_maps(  # noqa: PLR0913
+    path,
+    counts_map_eff,
+    counts_map_obs,
+    time_map_eff,
+    time_map_obs,
+    obs_id=None,
+):
+    """
+    Save the maps of one run as returned by
+    `ExclusionMapBackgroundMaker._fill_maps`. Times are stored in hours.
+    The obs_id is stored as well if given, see `read_run_obs_id`.
+    """
+    extra = {} if obs_id is None else {"obs_id": obs_id}
+    # Counts are integers, this keeps the files and the loaded maps small
+    np.savez_compressed(
+        path,
+        **extra,
+        counts_eff=np.asarray(counts_map_eff, dtype=np.uint32),
+        counts_obs=np.asarray(counts_map_obs, dtype=np.uint32),
+        times_eff=time_map_eff.to_value(u.h),
+        times_obs=time_map_obs.to_value(u.h),
+    )
+
+
+def read_run_maps(path):
+    """Inverse of `write_run_maps`."""
+    with np.load(path) as f:
+        return (
+            f["counts_eff"],
+            f["counts_obs"],
+            u.Quantity(f["times_eff"], u.h),
+            u.Quantity(f["times_obs"], u.h),
+        )
+
+
+def read_run_obs_id(path):
+    """Read the obs_id stored by `write_run_maps` without loading the maps"""
+    with np.load(path) as f:
+        return int(f["obs_id"])
+
+
+def write_cached_maps_index(path, run_files):
+    """
+    Write the mapping obs_id -> per-run maps file.
+    The files are stored relative to the index.
+    """
+    path = Path(path)
+    runs = {
+        str(obs_id): relpath(f, path.parent) for obs_id, f in sorted(run_files.items())
+    }
+    with open(path, "w") as f:
+        json.dump(runs, f, indent=2)
+
+
+def read_bkg_mapping(path):
+    """
+    Read the obs_id -> bkg file mapping written by calc_background.py.
+    The files are resolved relative to the mapping.
+    """
+    path = Path(path)
+    with open(path) as f:
+        mapping = json.load(f)
+    return {int(obs_id): path.parent / f for obs_id, f in mapping.items()}
+
+
+def read_cached_maps(path, obs_ids=None, counts_dtype=None):
+    """
+    Load the per-run maps listed in the index at `path`
+    in the format used by `ExclusionMapBackgroundMaker.run`.
+    If `counts_dtype` is given, the counts are kept as `CompactCounts`
+    of that dtype instead of dense float arrays.
+    """
+    path = Path(path)
+    with open(path) as f:
+        runs = {int(obs_id): path.parent / f for obs_id, f in json.load(f).items()}
+    if obs_ids is None:
+        obs_ids = runs.keys()
+
+    cached_maps = {"counts_obs": {}, "counts_eff": {}, "times_obs": {}, "times_eff": {}}
+    for obs_id in obs_ids:
+        counts_map_eff, counts_map_obs, time_map_eff, time_map_obs = read_run_maps(
+            runs[obs_id],
+        )
+        if counts_dtype is None:
+            counts_map_eff = counts_map_eff.astype(float)
+            counts_map_obs = counts_map_obs.astype(float)
+        else:
+            counts_map_eff = CompactCounts(counts_map_eff, counts_dtype)
+            counts_map_obs = CompactCounts(counts_map_obs, counts_dtype)
+        cached_maps["counts_eff"][obs_id] = counts_map_eff
+        cached_maps["counts_obs"][obs_id] = counts_map_obs
+        cached_maps["times_eff"][obs_id] = time_map_eff
+        cached_maps["times_obs"][obs_id] = time_map_obs
+    return cached_maps
+
+
 class ExclusionMapBackgroundMaker:
     """Exclusion map background algorithm.
     Calculates background in FOV coordinate system aligned with the `ALTAZ` system.
@@ -61,14 +422,34 @@ class ExclusionMapBackgroundMaker:
         n_offset_bins=8,
         n_subsample=3,
         n_time_bins=5,
+        time_bin_tolerance=None,
+        max_n_time_bins=100,
+        time_batch_size=4,
         offset_max="1.75 deg",
         gaussian_smoothing_3d=0.5,  # in pixels
+        adaptive_min_counts=None,
+        adaptive_max_level=4,
+        exclusion_binsz="0.01 deg",
+        counts_dtype=None,
+        altaz_time_resolution="10 s",
     ):
         self.e_reco = e_reco
         self.location = location
         self.nbins = nbins
         self.n_subsample = n_subsample
         self.n_time_bins = n_time_bins
+        # Maximum drift of the sky in the FoV within one time bin.
+        # If given, the number of time bins is chosen per run and
+        # n_time_bins is not used, see _get_n_time_bins
+        self.time_bin_tolerance = (
+            None if time_bin_tolerance is None else Angle(time_bin_tolerance)
+        )
+        # Upper limit of the number of time bins chosen with time_bin_tolerance
+        self.max_n_time_bins = max_n_time_bins
+        # number of time bins transformed at once, None means all.
+        # Each time bin needs (nbins * n_subsample)**2 coordinates,
+        # e.g. about 190 MB for nbins=400
+        self.time_batch_size = time_batch_size
         self.n_offset_bins = n_offset_bins
         self.offset_max = Angle(offset_max)
         self.offset = MapAxis.from_bounds(
@@ -120,142 +501,249 @@ class ExclusionMapBackgroundMaker:
         self.time_map_obs = u.Quantity(np.zeros((nbins, nbins)), u.h)
         self.time_map_eff = u.Quantity(np.zeros((nbins, nbins)), u.h)
         self.exclusion_geom = RegionGeom.from_regions(exclusion_regions)
+        # Rasterized exclusion regions for fast lookups,
+        # None uses the exact (but slower) region geometry
+        if exclusion_binsz is None:
+            self.exclusion_mask = self.exclusion_geom
+        else:
+            self.exclusion_mask = RasterizedExclusion(
+                exclusion_regions,
+                binsz=exclusion_binsz,
+            )
 
         self.gaussian_smoothing_3d = gaussian_smoothing_3d
+        # Merge pixels with less counts in the 3D model, see adaptive_rates
+        self.adaptive_min_counts = adaptive_min_counts
+        self.adaptive_max_level = adaptive_max_level
+        # dtype of the per-run counts returned by _fill_all_maps,
+        # None keeps dense float arrays
+        self.counts_dtype = counts_dtype
+        # spacing of the pointing trajectory used for the AltAz transformations
+        self.altaz_time_resolution = u.Quantity(altaz_time_resolution)
 
         log.debug("Calculating offset map from lon and lat axes")
         lon, lat = np.meshgrid(self.lon_axis.center.value, self.lat_axis.center.value)
         self.offset_map = np.sqrt(lon**2 + lat**2)
+        # Index of the offset bin of every pixel.
+        # Pixels outside of the offset axis get n_offset_bins
+        self.offset_idx = (
+            np.searchsorted(
+                self.offset.edges.to_value(u.deg),
+                self.offset_map,
+                side="right",
+            )
+            - 1
+        )
+        self.n_pixels_offset = np.bincount(
+            self.offset_idx.ravel(),
+            minlength=self.n_offset_bins + 1,
+        )[: self.n_offset_bins]
 
-    def _fill_counts(self, obs):
-        # hist events in evergy energy bin
+    def _altaz_cache(self, obs):
+        return AltAzTransformCache.from_observation(
+            obs,
+            self.location,
+            time_resolution=self.altaz_time_resolution,
+            fov_radius=np.sqrt(2) * self.offset_max,
+        )
+
+    def _fill_counts(self, obs, altaz_cache=None):
+        # hist events in every energy bin at once
         log.info(f"Filling counts map(s) for obs {obs.obs_id}")
+        if altaz_cache is None:
+            altaz_cache = self._altaz_cache(obs)
+        # obs.events reads the events file on every access
+        events = obs.events
         # convert coordinates from Ra/Dec to Alt/Az
-        t = obs.events.time
-        radec = obs.events.radec
-        exclusion_mask = ~self.exclusion_geom.contains(radec)
-        frame = AltAz(obstime=t, location=self.location)
-        pointing_altaz = obs.events.pointing_radec.transform_to(frame)
-        position_events = obs.events.radec.transform_to(frame)
-        for j in range(self.e_reco.nbin):
-            energy_mask = self.e_reco.edges[j] <= obs.events.energy
-            energy_mask &= obs.events.energy < self.e_reco.edges[j + 1]
-            mask = exclusion_mask & energy_mask
-            log.debug(
-                f"Transforming {np.count_nonzero(energy_mask)} events in bin {j}",
-            )
-            # convert Alt/Az to Alt/Az FoV
-            # effective counts
-            lon, lat = sky_to_fov(
-                position_events.az[mask],
-                position_events.alt[mask],
-                pointing_altaz.az[mask],
-                pointing_altaz.alt[mask],
-            )
-            counts_eff, xedges, yedges = np.histogram2d(
-                lon.value,
-                lat.value,
-                bins=(self.lon_axis.edges.value, self.lat_axis.edges.value),
-            )
-            # observed counts
-            lon, lat = sky_to_fov(
-                position_events.az[energy_mask],
-                position_events.alt[energy_mask],
-                pointing_altaz.az[energy_mask],
-                pointing_altaz.alt[energy_mask],
-            )
-            counts_obs, xedges, yedges = np.histogram2d(
-                lon.value,
-                lat.value,
-                bins=(self.lon_axis.edges.value, self.lat_axis.edges.value),
-            )
-            if j == 0:
-                counts_map_eff = counts_eff
-                counts_map_obs = counts_obs
-            else:
-                counts_map_eff = np.dstack((counts_map_eff, counts_eff))
-                counts_map_obs = np.dstack((counts_map_obs, counts_obs))
-        counts_map_eff = counts_map_eff.transpose()
-        counts_map_obs = counts_map_obs.transpose()
+        t = events.time
+        radec = events.radec
+        exclusion_mask = ~self.exclusion_mask.contains(radec)
+        log.debug(f"Transforming {len(radec)} events")
+        az, alt = altaz_cache.icrs_to_altaz_rad(radec.ra.rad, radec.dec.rad, t)
+        pointing_az, pointing_alt = altaz_cache.pointing_altaz_rad(t)
+        # convert Alt/Az to Alt/Az FoV
+        # This is done once for all events and in place, the energy binning is
+        # handled by the histogram
+        lon, lat = sky_to_fov(az, alt, pointing_az, pointing_alt, out=(az, alt))
+        energy = events.energy.to_value(self.e_reco.unit)
+        # The energy bins are half-open, so events at the upper edge are not counted
+        energy_mask = energy < self.e_reco.edges[-1].to_value(self.e_reco.unit)
+        # (energy, lat, lon) to match the layout of the counts maps
+        sample = np.column_stack((energy, np.rad2deg(lat), np.rad2deg(lon)))
+        bins = (
+            self.e_reco.edges.to_value(self.e_reco.unit),
+            self.lat_axis.edges.to_value(u.deg),
+            self.lon_axis.edges.to_value(u.deg),
+        )
+        # observed counts
+        counts_map_obs, _ = np.histogramdd(sample[energy_mask], bins=bins)
+        # effective counts
+        counts_map_eff, _ = np.histogramdd(
+            sample[energy_mask & exclusion_mask],
+            bins=bins,
+        )
         return counts_map_eff, counts_map_obs
 
-    def _fill_time_maps(self, obs):
+    def _fill_time_maps(self, obs, altaz_cache=None):
         log.info(f"Filling time map(s) for obs {obs.obs_id}")
+        if altaz_cache is None:
+            altaz_cache = self._altaz_cache(obs)
         # time_map
-        t_binning = np.linspace(obs.tstart.value, obs.tstop.value, self.n_time_bins)
+        n_time_bins = self._get_n_time_bins(altaz_cache)
+        log.debug(f"Using {n_time_bins - 1} time bins for obs {obs.obs_id}")
+        t_binning = np.linspace(obs.tstart.value, obs.tstop.value, n_time_bins)
         t_binning = Time(t_binning, format="mjd")
-        t_delta = np.diff(t_binning)
+        t_delta = t_binning[1:] - t_binning[:-1]
         t_center = t_binning[:-1] + 0.5 * t_delta
+        t_delta = t_delta.to_value(u.h)
+
+        # We have a n-deg square, so some pixels
+        # are more than n-deg away from the center
+        # This does not depend on the time, so only do it once
         lon, lat = np.meshgrid(self.lon_axis.center, self.lat_axis.center)
+        coord_lonlat = SkyCoord(lon, lat)
+        mask_fov = (
+            coord_lonlat.separation(SkyCoord(0 * u.deg, 0 * u.deg)) < self.offset_max
+        )
+
+        # Process the time bins in batches. The pointing transformation
+        # and the exclusion lookup are done once for all time bins of a batch,
+        # which needs memory for batch_size * (nbins * n_subsample)**2 coordinates
+        batch_size = self.time_batch_size or len(t_center)
+        exclusion_weight = np.concatenate(
+            [
+                self._get_exclusion_weights(
+                    altaz_cache,
+                    t_center[i : i + batch_size],
+                )
+                for i in range(0, len(t_center), batch_size)
+            ],
+        )
+
         # create observation time 2d arrays
         observation_time_obs = np.zeros((self.nbins, self.nbins))
         observation_time_eff = np.zeros((self.nbins, self.nbins))
-        # iterate time bins
-        pointing_positions = []
-        for t_c, t_d in zip(t_center, t_delta):
-            # transform from camera coordinates to FoV coordinates (Alt/Az)
-            # dependent on the time
-            frame = AltAz(obstime=t_c, location=self.location)
-            pointing_position = obs.pointing_radec.transform_to(frame)
-            pointing_positions.append(pointing_position)
-            # Use fine axis to account for partial overlap
-            az, alt = fov_to_sky(
-                self.lon_axis_fine.center,
-                self.lat_axis_fine.center,
-                pointing_position.az,
-                pointing_position.alt,
-            )
-            az, alt = np.meshgrid(az, alt)
-
-            # Exclusion mask needs to be constructed for each time bin, because
-            # the source will move in the FoV
-            coord_radec = SkyCoord(az, alt, frame=frame).transform_to("icrs")
-            # Need some reshape magic to get the correct form
-            ex = ~self.exclusion_geom.contains(coord_radec)
-            ex = ex.reshape(ex.shape[0], self.nbins, self.n_subsample).mean(axis=-1)
-            exclusion_weight = (
-                ex.T.reshape(self.nbins, self.nbins, self.n_subsample).mean(axis=-1)
-            ).T
-
-            # We have a n-deg square, so some pixels
-            # are more than n-deg away from the center
-            coord_lonlat = SkyCoord(lon, lat)
-            mask_fov = (
-                coord_lonlat.separation(SkyCoord(0 * u.deg, 0 * u.deg))
-                < self.offset_max
-            )
-            # fill observatione time 2d arays
-            observation_time_obs[mask_fov] += t_d.to(u.Unit(u.h)).value
-            observation_time_eff += (
-                t_d.to(u.Unit(u.h)).value * mask_fov * exclusion_weight
-            )
+        # fill observation time 2d arrays
+        for t_d, weight in zip(t_delta, exclusion_weight):
+            observation_time_obs[mask_fov] += t_d
+            observation_time_eff += t_d * mask_fov * weight
         return u.Quantity(observation_time_eff, u.h), u.Quantity(
             observation_time_obs,
             u.h,
         )
 
+    def _get_n_time_bins(self, altaz_cache):
+        """
+        Number of time bin edges for the time maps of one run.
+        With a ``time_bin_tolerance``, this is chosen so that points fixed on the
+        sky move at most by the tolerance in the FoV within one time bin.
+        Points at the edge of the FoV move the most, because the FoV
+        rotates with the pointing moving in Alt/Az.
+        The number of bins is limited to ``max_n_time_bins``.
+        """
+        if self.time_bin_tolerance is None:
+            return self.n_time_bins
+        edge = altaz_cache.pointing.directional_offset_by(
+            np.arange(0, 360, 45) * u.deg,
+            self.offset_max,
+        )
+        # Use the time grid of the cache, that is the resolution of the trajectory
+        times = altaz_cache.times
+        az, alt = altaz_cache.icrs_to_altaz_rad(
+            edge.ra.rad,
+            edge.dec.rad,
+            times[:, np.newaxis],
+        )
+        pointing_az, pointing_alt = altaz_cache.pointing_altaz_rad(times)
+        lon, lat = sky_to_fov(
+            az,
+            alt,
+            pointing_az[:, np.newaxis],
+            pointing_alt[:, np.newaxis],
+            out=(az, alt),
+        )
+        # Path length in the FoV, the movement is not necessarily linear
+        drift = np.sum(
+            np.hypot(np.diff(lon, axis=0), np.diff(lat, axis=0)),
+            axis=0,
+        ).max()
+        n_bins = int(np.ceil(drift / self.time_bin_tolerance.to_value(u.rad)))
+        # Bins smaller than the resolution of the trajectory do not help
+        n_bins = min(max(n_bins, 1), len(times) - 1, self.max_n_time_bins)
+        return n_bins + 1
+
+    def _get_exclusion_weights(self, altaz_cache, t_center):
+        """
+        Fraction of every pixel outside of the exclusion regions
+        for each of the time bins centered on ``t_center``.
+        Returns an array of shape (n_times, nbins, nbins).
+        """
+        n_times = len(t_center)
+        n_fine = self.nbins * self.n_subsample
+        # transform from camera coordinates to FoV coordinates (Alt/Az)
+        # dependent on the time. This is one call for all time bins
+        pointing_az, pointing_alt = altaz_cache.pointing_altaz_rad(t_center)
+        # Use fine axis to account for partial overlap
+        az, alt = fov_to_sky(
+            self.lon_axis_fine.center.to_value(u.rad),
+            self.lat_axis_fine.center.to_value(u.rad),
+            pointing_az[:, np.newaxis],
+            pointing_alt[:, np.newaxis],
+        )
+
+        # Exclusion mask needs to be constructed for each time bin, because
+        # the source will move in the FoV.
+        # Same as a meshgrid of az and alt for every time bin
+        shape = (n_times, n_fine, n_fine)
+        ra, dec = altaz_cache.altaz_to_icrs_rad(
+            np.broadcast_to(az[:, np.newaxis, :], shape),
+            np.broadcast_to(alt[:, :, np.newaxis], shape),
+            t_center[:, np.newaxis, np.newaxis],
+        )
+        ex = ~self.exclusion_mask.contains(SkyCoord(ra, dec, unit=u.rad))
+        # Average the subsampled pixels, first along lon, then along lat
+        ex = ex.reshape(
+            n_times,
+            self.nbins,
+            self.n_subsample,
+            self.nbins,
+            self.n_subsample,
+        )
+        return ex.mean(axis=4).mean(axis=2)
+
+    def _fill_maps(self, obs):
+        # The pointing trajectory is shared by the counts and the time maps
+        altaz_cache = self._altaz_cache(obs)
+        counts_map_eff, counts_map_obs = self._fill_counts(obs, altaz_cache)
+        time_map_eff, time_map_obs = self._fill_time_maps(obs, altaz_cache)
+        alpha_obs = time_map_eff / time_map_obs
+        # remove pixels with less than half the nominal observation time
+        # this avoids inflating the counts there
+        threshold = 0.5
+        mask_low_exposure = alpha_obs < threshold
+        time_map_eff[mask_low_exposure] = 0
+        counts_map_eff[:, mask_low_exposure] = 0
+        return counts_map_eff, counts_map_obs, time_map_eff, time_map_obs
+
+    def _iter_maps(self, data_store, obs_ids=None):
+        """
+        Fill the maps run by run, yielding ``(obs_id, maps)``
+        in the order of the observations.
+        Only the maps of the run currently processed are kept in memory.
+        """
+        observations = data_store.get_observations(obs_ids, required_irf=[])
+        for obs in observations:
+            yield obs.obs_id, self._fill_maps(obs)
+
     def _fill_all_maps(self, data_store, obs_ids=None):
         counts_obs = {}
         times_obs = {}
         counts_eff = {}
         times_eff = {}
-        observations = data_store.get_observations(obs_ids, required_irf=[])
-        for obs in observations:
-            counts_map_eff, counts_map_obs = self._fill_counts(obs)
-            time_map_eff, time_map_obs = self._fill_time_maps(obs)
-            alpha_obs = time_map_eff / time_map_obs
-            # remove pixels with less than half the nominal observation time
-            # this avoids inflating the counts there
-            threshold = 0.5
-            mask_low_exposure = alpha_obs < threshold
-            time_map_eff[mask_low_exposure] = 0
-            counts_map_eff[:, mask_low_exposure] = 0
-
-            counts_eff[obs.obs_id] = counts_map_eff
-            counts_obs[obs.obs_id] = counts_map_obs
-
-            times_eff[obs.obs_id] = time_map_eff
-            times_obs[obs.obs_id] = time_map_obs
+        for obs_id, maps in self._iter_maps(data_store, obs_ids):
+            self._store_maps(obs_id, maps, counts_eff, counts_obs)
+            times_eff[obs_id] = maps[2]
+            times_obs[obs_id] = maps[3]
         return {
             "counts_obs": counts_obs,
             "counts_eff": counts_eff,
@@ -263,21 +751,78 @@ class ExclusionMapBackgroundMaker:
             "times_eff": times_eff,
         }
 
+    def _store_maps(self, obs_id, maps, counts_eff, counts_obs):
+        # Compact the counts directly, so only one dense cube is alive at a time
+        counts_map_eff, counts_map_obs = maps[:2]
+        if self.counts_dtype is not None:
+            counts_map_eff = CompactCounts(counts_map_eff, self.counts_dtype)
+            counts_map_obs = CompactCounts(counts_map_obs, self.counts_dtype)
+        counts_eff[obs_id] = counts_map_eff
+        counts_obs[obs_id] = counts_map_obs
+
     def run(self, data_store, obs_ids=None, cached_maps=None):
         log.info(f"running on {obs_ids}")
-        observations = data_store.get_observations(obs_ids, required_irf=[])
         if cached_maps is None:
-            cached_maps = self._fill_all_maps(data_store, obs_ids)
-        for obs in observations:
-            counts_map_eff = cached_maps["counts_eff"][obs.obs_id]
-            counts_map_obs = cached_maps["counts_obs"][obs.obs_id]
-            times_map_eff = cached_maps["times_eff"][obs.obs_id]
-            times_map_obs = cached_maps["times_obs"][obs.obs_id]
-
-            self.counts_map_eff += counts_map_eff
-            self.counts_map_obs += counts_map_obs
-            self.time_map_eff += times_map_eff
-            self.time_map_obs += times_map_obs
+            # Without cached maps, the runs are accumulated one by one
+            for _, maps in self._iter_maps(data_store, obs_ids):
+                self._add_run_maps(*maps)
+        else:
+            observations = data_store.get_observations(obs_ids, required_irf=[])
+            self.add_maps(cached_maps, [obs.obs_id for obs in observations])
+        self.finalize()
+
+    def partial_fit(self, obs):
+        """
+        Fill the maps of a single observation and add them to the summed maps.
+        Call `finalize` after the last observation to get the background rates.
+        """
+        self._add_run_maps(*self._fill_maps(obs))
+        return self
+
+    def merge(self, other):
+        """
+        Add the summed maps of another maker, e.g. from a parallel job
+        or a previous night. Both need to use the same binning.
+        """
+        for attr in ("e_reco", "lon_axis", "lat_axis", "offset"):
+            if getattr(self, attr) != getattr(other, attr):
+                raise ValueError(f"Cannot merge makers with different {attr}")
+        self._add_run_maps(
+            other.counts_map_eff,
+            other.counts_map_obs,
+            other.time_map_eff,
+            other.time_map_obs,
+        )
+        return self
+
+    def _add_run_maps(self, counts_map_eff, counts_map_obs, time_map_eff, time_map_obs):
+        self.counts_map_eff += counts_map_eff
+        self.counts_map_obs += counts_map_obs
+        self.time_map_eff += time_map_eff
+        self.time_map_obs += time_map_obs
+
+    def add_maps(self, cached_maps, obs_ids):
+        """Add the cached maps of the given runs to the summed maps."""
+        for obs_id in obs_ids:
+            _add_counts(self.counts_map_eff, cached_maps["counts_eff"][obs_id])
+            _add_counts(self.counts_map_obs, cached_maps["counts_obs"][obs_id])
+            self.time_map_eff += cached_maps["times_eff"][obs_id]
+            self.time_map_obs += cached_maps["times_obs"][obs_id]
+
+    def remove_maps(self, cached_maps, obs_ids):
+        """
+        Remove the cached maps of the given runs from the summed maps.
+        Together with `add_maps` this allows to slide over a list of runs
+        without summing all runs again for every step.
+        """
+        for obs_id in obs_ids:
+            _add_counts(self.counts_map_eff, cached_maps["counts_eff"][obs_id], -1)
+            _add_counts(self.counts_map_obs, cached_maps["counts_obs"][obs_id], -1)
+            self.time_map_eff -= cached_maps["times_eff"][obs_id]
+            self.time_map_obs -= cached_maps["times_obs"][obs_id]
+
+    def finalize(self):
+        """Calculate the background rates from the summed maps."""
         # 0/0 is nan...
         self.alpha_map = np.nan_to_num(
             self.time_map_eff / self.time_map_obs,
@@ -288,47 +833,44 @@ class ExclusionMapBackgroundMaker:
         self.bg = self._get_bg_offset()
         self.bg_rate = self.get_bg_rate()
 
-    def _get_bg_offset_1r(self, counts_map):
+    def _get_bg_offset(self):
         """
         For every offset bin find pixels with matching distance
         and calculate the mean bkg rate.
+        This is done for all energy bins at once and returns an
+        array of shape (n_energy, n_offset).
         """
-        rmin = self.offset.edges.value[:-1] * self.offset.unit
-        rmax = self.offset.edges.value[1:] * self.offset.unit
-        bg_offset = []
-        for rmi, rma in zip(rmin, rmax):
-            mask = (self.offset_map >= rmi.value) & (self.offset_map < rma.value)
-            log.debug(f"Mean over {np.count_nonzero(mask)} entries")
-            sum_counts = np.sum(counts_map[mask])
-            solid_angle_diff = cone_solid_angle(rma) - cone_solid_angle(rmi)
-
-            mean_time_eff = np.mean(self.time_map_eff[mask])
-            log.debug(f"Mean time: {mean_time_eff}")
-            # This is actually a rate (counts/time/angle)
-            counts_corrected = sum_counts / mean_time_eff / solid_angle_diff
-            log.debug(f"counts: {counts_corrected} for {rmi}-{rma}")
-            log.debug(f": ({solid_angle_diff}) {sum_counts}")
-            bg_offset.append(counts_corrected.value)
-        return np.array(bg_offset) * counts_corrected.unit
+        n_energy = self.e_reco.nbin
+        n_offset = self.n_offset_bins
+        # Combined (energy, offset) index for every pixel in every energy bin
+        idx = self.offset_idx.ravel()
+        idx_energy = np.arange(n_energy)[:, np.newaxis] * (n_offset + 1) + idx
+        sum_counts = np.bincount(
+            idx_energy.ravel(),
+            weights=self.counts_map_eff.ravel(),
+            minlength=n_energy * (n_offset + 1),
+        ).reshape(n_energy, n_offset + 1)[:, :n_offset]
+        log.debug(f"Summed counts: {sum_counts}")
 
-    def _get_bg_offset(self):
-        """
-        Create map of background rates for every bin in the time map
-        """
-        return [self._get_bg_offset_1r(c) for c in self.counts_map_eff]
+        sum_time_eff = np.bincount(
+            idx,
+            weights=self.time_map_eff.value.ravel(),
+            minlength=n_offset + 1,
+        )[:n_offset]
+        mean_time_eff = sum_time_eff / self.n_pixels_offset * self.time_map_eff.unit
+        log.debug(f"Mean time: {mean_time_eff}")
+
+        solid_angle_diff = np.diff(cone_solid_angle(self.offset.edges))
+        # This is actually a rate (counts/time/angle)
+        return sum_counts / mean_time_eff / solid_angle_diff
 
     def get_bg_rate(self):
         """
         Divide rates by energy bin widths oto get the differential rate
         """
-        bg_rate = []
         background_unit = u.Unit("s-1 MeV-1 sr-1")
-        for bg_r, e_width in zip(self.bg, self.e_reco.bin_width):
-            a = bg_r / e_width
-            a = a.to(background_unit)
-            log.debug(f"{a}")
-            bg_rate.append(a)
-        return bg_rate
+        bg_rate = self.bg / self.e_reco.bin_width[:, np.newaxis]
+        return bg_rate.to(background_unit)
 
     def get_bg_2d(self):
         # This uses self.bg_rate
@@ -341,11 +883,45 @@ class ExclusionMapBackgroundMaker:
         )
         return bg_2d
 
-    def get_bg_3d(self):
+    def _adaptive_rates(self, solid_angle_pixel):
+        exposure = solid_angle_pixel * self.time_map_eff
+        rates, levels = adaptive_rates(
+            self.counts_map_eff,
+            exposure.value,
+            self.adaptive_min_counts,
+            self.adaptive_max_level,
+        )
+        return rates / exposure.unit, levels, exposure
+
+    def _resample_factor(self, levels):
+        """Largest power of 2 dividing nbins, up to the coarsest level of all pixels"""
+        exposed = self.time_map_eff > 0
+        factor = 2 ** int(levels[:, exposed].min(initial=self.adaptive_max_level))
+        while self.nbins % factor != 0:
+            factor //= 2
+        return factor
+
+    def adaptive_resample_factor(self):
+        """
+        Factor by which `get_bg_3d` resamples the spatial axes
+        with adaptive binning, 1 without it.
+        """
+        if not self.adaptive_min_counts:
+            return 1
+        lon, lat = np.meshgrid(self.lon_axis.bin_width, self.lat_axis.bin_width)
+        solid_angle_pixel = cone_solid_angle_rectangular_pyramid(lon, lat)
+        _, levels, _ = self._adaptive_rates(solid_angle_pixel)
+        return self._resample_factor(levels)
+
+    def get_bg_3d(self, resample_factor=None):
         """
         Calculate the fulld 3D bkg map.
         This works on the maps itself, not on the
         quantities calculated by the other get_bg functions
+
+        With adaptive binning, the spatial axes are resampled by
+        `adaptive_resample_factor` if ``resample_factor`` is None.
+        Models that are combined later on need a common ``resample_factor``.
         """
         # This instead uses the counts, time and alpha maps
         bg_rate = []
@@ -355,23 +931,49 @@ class ExclusionMapBackgroundMaker:
         # Careful: This is the bin widths this time!
         lon, lat = np.meshgrid(self.lon_axis.bin_width, self.lat_axis.bin_width)
         solid_angle_pixel = cone_solid_angle_rectangular_pyramid(lon, lat)
+        exposure = solid_angle_pixel * self.time_map_eff
 
-        bg_rate = (
-            self.counts_map_eff
-            / self.e_reco.bin_width.reshape(len(self.e_reco.bin_width), 1, 1)
-            / solid_angle_pixel
-            / self.time_map_eff
-        )
-        # TODO Can this be broadcasted?
+        e_bin_width = self.e_reco.bin_width.reshape(len(self.e_reco.bin_width), 1, 1)
+        if self.adaptive_min_counts:
+            rates, levels, exposure = self._adaptive_rates(solid_angle_pixel)
+            bg_rate = rates / e_bin_width
+            if resample_factor is None:
+                # If no pixel needs the full resolution, write a coarser model
+                resample_factor = self._resample_factor(levels)
+        else:
+            bg_rate = (
+                self.counts_map_eff
+                / e_bin_width
+                / solid_angle_pixel
+                / self.time_map_eff
+            )
         if self.gaussian_smoothing_3d:
-            smoothing_kernel = Gaussian2DKernel(self.gaussian_smoothing_3d)
-            for i in np.arange(len(bg_rate)):
-                bg_rate[i] = convolve(bg_rate[i], smoothing_kernel)
+            bg_rate = smooth_fov_maps(bg_rate, self.gaussian_smoothing_3d)
 
         # nans and infs come from division by zero time, so they should be zero
         bg_rate = np.nan_to_num(bg_rate, nan=0.0, posinf=0, neginf=0)
+        lon_axis, lat_axis = self.lon_axis, self.lat_axis
+        factor = resample_factor or 1
+        if self.nbins % factor != 0:
+            raise ValueError(f"nbins={self.nbins} is not divisible by {factor}")
+        if factor > 1:
+            log.info(f"Resampling the 3D background by a factor of {factor}")
+            weight = exposure.value
+            bg_rate = np.nan_to_num(
+                _block_sum(bg_rate * weight, factor) / _block_sum(weight, factor),
+            )
+            lon_axis = MapAxis.from_edges(
+                lon_axis.edges[::factor],
+                interp="lin",
+                name=lon_axis.name,
+            )
+            lat_axis = MapAxis.from_edges(
+                lat_axis.edges[::factor],
+                interp="lin",
+                name=lat_axis.name,
+            )
         bg_3d = Background3D(
-            axes=[self.e_reco, self.lon_axis, self.lat_axis],
+            axes=[self.e_reco, lon_axis, lat_axis],
             data=bg_rate.to(background_unit),
             unit=background_unit,
             fov_alignment=FoVAlignment.ALTAZ,
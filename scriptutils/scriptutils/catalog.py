@@ -0,0 +1,124 @@
+"""Run catalogue of the data selection in a sqlite database."""
+
+import logging
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+import numpy as np
+from astropy.table import Table
+
+log = logging.getLogger(__name__)
+
+TABLE = "runs"
+INDEXED_COLUMNS = ["night", "zenith", "selected"]
+
+
+def _quote(name):
+    return f'"{name}"'
+
+
+def _sql_type(dtype):
+    if dtype.kind == "b":
+        return "BOOLEAN"
+    if dtype.kind in "iu":
+        return "INTEGER"
+    if dtype.kind == "f":
+        return "REAL"
+    return None
+
+
+def write_run_catalog(path, runsummary, run_id_strs, nights, selected):
+    """
+    Write the runs of a (masked) runsummary to a new catalogue.
+
+    All scalar numeric and boolean columns (datacheck metrics, pointing,
+    moon and mask columns) are stored together with the zenith and azimuth
+    of the pointing in deg. Runs are identified by ``run_id`` (the runnumber).
+
+    Parameters
+    ----------
+    path: str or Path
+        The sqlite file, an existing one is replaced.
+    runsummary: astropy.table.Table
+        The runsummary, e.g. as written by data-check.py.
+    run_id_strs: dict
+        Run id as used in the file names (as in the runlist) of every run_id.
+    nights: dict
+        Night (date directory) of every run_id.
+    selected: set
+        Run ids of the selected runs.
+    """
+    run_ids = np.asarray(runsummary["runnumber"]).tolist()
+    columns = {
+        "run_id": ("INTEGER PRIMARY KEY", run_ids),
+        "run_id_str": ("TEXT", [run_id_strs.get(r) for r in run_ids]),
+        "night": ("TEXT", [nights.get(r) for r in run_ids]),
+        "selected": ("BOOLEAN", [r in selected for r in run_ids]),
+        "zenith": ("REAL", (90 - np.rad2deg(runsummary["mean_altitude"])).tolist()),
+        "azimuth": ("REAL", np.rad2deg(runsummary["mean_azimuth"]).tolist()),
+    }
+    for name in runsummary.colnames:
+        values = np.asarray(runsummary[name])
+        sql_type = _sql_type(values.dtype)
+        if name == "runnumber" or name in columns or values.ndim != 1:
+            continue
+        if sql_type is None:
+            log.debug(f"Not storing column {name} of type {values.dtype}")
+            continue
+        columns[name] = (sql_type, values.tolist())
+
+    path = Path(path)
+    path.unlink(missing_ok=True)
+    with closing(sqlite3.connect(path)) as con, con:
+        definition = ", ".join(
+            f"{_quote(name)} {t}" for name, (t, _) in columns.items()
+        )
+        con.execute(f"CREATE TABLE {TABLE} ({definition})")
+        con.executemany(
+            f"INSERT OR REPLACE INTO {TABLE} VALUES ({', '.join('?' * len(columns))})",
+            zip(*(values for _, values in columns.values())),
+        )
+        for name in INDEXED_COLUMNS:
+            con.execute(f"CREATE INDEX idx_{name} ON {TABLE} ({_quote(name)})")
+    log.info(f"Wrote {len(run_ids)} runs to the run catalogue {path}")
+
+
+def read_run_catalog(path, where=None, params=(), columns=None):
+    """
+    Runs of the catalogue as astropy table, ordered by run id.
+
+    ``where`` is an optional sql condition with ``params`` as placeholder values,
+    e.g. ``read_run_catalog(path, "selected AND zenith < ?", (30,))``.
+    """
+    with closing(sqlite3.connect(path)) as con:
+        types = {row[1]: row[2] for row in con.execute(f"PRAGMA table_info({TABLE})")}
+        names = columns or list(types)
+        query = f"SELECT {', '.join(map(_quote, names))} FROM {TABLE}"
+        if where is not None:
+            query += f" WHERE {where}"
+        rows = con.execute(f"{query} ORDER BY run_id", params).fetchall()
+
+    table = Table()
+    for i, name in enumerate(names):
+        values = [row[i] for row in rows]
+        if types[name] == "REAL":
+            # NaN is stored as NULL
+            table[name] = np.array(values, dtype=float)
+        elif types[name] == "BOOLEAN":
+            table[name] = np.array(values, dtype=bool)
+        elif types[name].startswith("INTEGER"):
+            table[name] = np.array(values, dtype=np.int64)
+        else:
+            table[name] = np.array(values, dtype=object)
+    return table
+
+
+def read_runs_by_night(path, selected=True):
+    """Run ids (as in the file names) of every night."""
+    where = "selected" if selected else None
+    runs = read_run_catalog(path, where, columns=["night", "run_id_str"])
+    nights = {}
+    for night, run_id in zip(runs["night"], runs["run_id_str"]):
+        nights.setdefault(night, []).append(run_id)
+    return {night: sorted(run_ids) for night, run_ids in sorted(nights.items())}
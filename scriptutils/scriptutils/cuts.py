@@ -0,0 +1,106 @@
+"""Quality cuts of the run selection, evaluated for several configs at once."""
+
+import logging
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class Cut(NamedTuple):
+    """
+    Cut on a runsummary column with the `Limits` of a config field.
+
+    Sigma based bounds are calculated from the runs selected by all cuts of
+    previous stages (and ``reference``, an additional mask, if given).
+    Cuts of the same stage are independent of each other.
+    """
+
+    name: str
+    column: str
+    limits: str
+    stage: int
+    reference: Optional[str] = None
+
+
+QUALITY_CUTS = [
+    Cut(
+        "mask_pedestal_charge",
+        "ped_charge_stddev",
+        "pedestal",
+        stage=0,
+        reference="moon_below_horizon",
+    ),
+    Cut("mask_cosmics", "cosmics_rate", "cosmics", stage=1),
+    Cut("mask_cosmics_above10", "cosmics_rate_above10", "cosmics_10", stage=2),
+    Cut("mask_cosmics_above30", "cosmics_rate_above30", "cosmics_30", stage=2),
+]
+
+
+def _limits(configs, field):
+    limits = [getattr(config, field) for config in configs]
+    ll = np.array([limit.ll for limit in limits], dtype=float)
+    ul = np.array([limit.ul for limit in limits], dtype=float)
+    sigma = np.array(
+        [np.nan if limit.sigma is None else limit.sigma for limit in limits],
+    )
+    return ll, ul, sigma
+
+
+def evaluate_cuts(columns, configs, mask, cuts=QUALITY_CUTS, reference_masks=None):
+    """
+    Evaluate the cuts for every config.
+
+    Parameters
+    ----------
+    columns: mapping
+        Runsummary columns (e.g. an astropy table) with shape (n_runs,).
+    configs: list of scriptutils.config.Config
+        The selection configs.
+    mask: np.ndarray
+        Runs selected before the cuts with shape (n_runs,)
+        or (n_configs, n_runs).
+    cuts: list of Cut
+        The cuts, stages are evaluated in ascending order.
+    reference_masks: dict
+        Additional masks for the sigma bounds by name, see `Cut`.
+
+    Returns
+    -------
+    masks: np.ndarray
+        Result of every cut with shape (n_configs, n_cuts, n_runs).
+    bounds: np.ndarray
+        Lower and upper bound of every cut with shape (n_configs, n_cuts, 2).
+    """
+    reference_masks = reference_masks or {}
+    n_runs = len(columns[cuts[0].column])
+    selected = np.broadcast_to(mask, (len(configs), n_runs)).copy()
+    masks = np.zeros((len(configs), len(cuts), n_runs), dtype=bool)
+    bounds = np.zeros((len(configs), len(cuts), 2))
+
+    for stage in sorted({cut.stage for cut in cuts}):
+        stage_idx = [i for i, cut in enumerate(cuts) if cut.stage == stage]
+        for i in stage_idx:
+            cut = cuts[i]
+            values = np.asarray(columns[cut.column], dtype=float)
+            ll, ul, sigma = _limits(configs, cut.limits)
+            with_sigma = np.isfinite(sigma)
+            if np.any(with_sigma):
+                reference = selected[with_sigma]
+                if cut.reference is not None:
+                    reference = reference & reference_masks[cut.reference]
+                # Same as stats.bounds_std for every config
+                reference_values = np.where(reference, values, np.nan)
+                mean = np.nanmean(reference_values, axis=1)
+                std = sigma[with_sigma] * np.nanstd(reference_values, axis=1)
+                ll[with_sigma] = mean - std
+                ul[with_sigma] = mean + std
+            bounds[:, i, 0] = ll
+            bounds[:, i, 1] = ul
+            masks[:, i] = np.logical_and(
+                np.greater_equal(values, ll[:, np.newaxis]),
+                np.less_equal(values, ul[:, np.newaxis]),
+            )
+        selected &= masks[:, stage_idx].all(axis=1)
+    return masks, bounds
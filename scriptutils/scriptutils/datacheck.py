@@ -0,0 +1,124 @@
+"""Per-run checks of data-check.py, cached between calls."""
+
+import hashlib
+import json
+import logging
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+from astropy.time import Time
+
+log = logging.getLogger(__name__)
+
+# Columns of the runsummary the per-run columns are computed from
+# and the per-run columns, which only depend on their own row
+per_run_inputs = ["time", "mean_ra", "mean_dec", "mean_altitude", "num_pedestals"]
+per_run_columns = [
+    "mask_pedestals_ok",
+    "mask_separation_low",
+    "mask_zenith",
+    "moon_altitude",
+    "moon_illumination",
+]
+
+
+def get_moon_info(runsummary, ephemeris):
+    time = Time(runsummary["time"], format="unix", scale="utc")
+    return ephemeris(time)
+
+
+def get_per_run_columns(runsummary, config, ephemeris):
+    """Masks and moon information that only depend on the run itself"""
+    columns = {"mask_pedestals_ok": np.isfinite(runsummary["num_pedestals"])}
+
+    # Exclude runs that are too far from source
+    tel_pointing = SkyCoord(
+        ra=u.Quantity(runsummary["mean_ra"], u.deg),
+        dec=u.Quantity(runsummary["mean_dec"], u.deg),
+    )
+
+    source_coordinates = SkyCoord(
+        ra=config.source_ra_deg,
+        dec=config.source_dec_deg,
+        unit=u.deg,
+    )
+
+    separation = tel_pointing.separation(source_coordinates)
+
+    columns["mask_separation_low"] = np.isclose(
+        u.Quantity(0.4, u.deg),
+        separation,
+        rtol=0,
+        atol=0.15,
+    )
+
+    zenith = 90 - np.rad2deg(runsummary["mean_altitude"])
+    columns["mask_zenith"] = np.asarray(zenith < config.max_zenith_deg)
+
+    columns["moon_altitude"], columns["moon_illumination"] = get_moon_info(
+        runsummary,
+        ephemeris,
+    )
+    return columns
+
+
+def per_run_config_key(config):
+    """Hash of the config values the per-run columns depend on"""
+    values = [config.source_ra_deg, config.source_dec_deg, config.max_zenith_deg]
+    return hashlib.sha256(json.dumps(values).encode()).hexdigest()[:16]
+
+
+def load_per_run_columns(runsummary, config, cache, ephemeris):
+    """
+    Per-run columns for all runs of the runsummary.
+    Runs with identical inputs in the cache of a previous
+    call are taken from there, only the others are computed.
+    """
+    n_runs = len(runsummary)
+    key = per_run_config_key(config)
+    new = np.ones(n_runs, dtype=bool)
+    columns = {}
+    if cache is not None and cache.exists():
+        cached = Table.read(cache, path="data")
+        if cached.meta.get("CONFIG_KEY") != key:
+            log.info("Selection config changed, ignoring the cached datachecks")
+        elif len(cached) == 0:
+            log.info("No runs in the cached datachecks")
+        else:
+            order = np.argsort(cached["runnumber"])
+            idx = np.searchsorted(
+                cached["runnumber"],
+                runsummary["runnumber"],
+                sorter=order,
+            )
+            idx = order[np.clip(idx, 0, len(order) - 1)]
+            found = np.asarray(cached["runnumber"][idx] == runsummary["runnumber"])
+            for name in per_run_inputs:
+                a = np.asarray(runsummary[name])
+                b = np.asarray(cached[name][idx])
+                found &= (a == b) | (np.isnan(a) & np.isnan(b))
+            new = ~found
+            columns = {name: np.asarray(cached[name][idx]) for name in per_run_columns}
+    log.info(f"Computing per-run checks for {np.count_nonzero(new)} / {n_runs} runs")
+
+    # Also without any run, so that all columns exist
+    if np.any(new) or not columns:
+        computed = get_per_run_columns(runsummary[new], config, ephemeris)
+        for name, values in computed.items():
+            if name not in columns:
+                columns[name] = np.empty(n_runs, dtype=np.asarray(values).dtype)
+            columns[name][new] = values
+
+    if cache is not None:
+        cache.parent.mkdir(exist_ok=True, parents=True)
+        table = Table(
+            [runsummary["runnumber"]]
+            + [np.asarray(runsummary[name]) for name in per_run_inputs]
+            + [columns[name] for name in per_run_columns],
+            names=["runnumber", *per_run_inputs, *per_run_columns],
+            meta={"CONFIG_KEY": key},
+        )
+        table.write(cache, path="data", serialize_meta=True, overwrite=True)
+    return columns
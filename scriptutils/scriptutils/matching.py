@@ -0,0 +1,116 @@
+"""Matching of runs to the background models of calc_background.py."""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def check_nodes(nodes, name, period=None):
+    """
+    Interpolation nodes as float array, which need to be strictly increasing.
+    With a `period`, they also need to lie within one period,
+    so that no two nodes are the same after wrapping around.
+    """
+    nodes = np.asarray(nodes, dtype=float)
+    if nodes.ndim != 1 or len(nodes) == 0:
+        raise ValueError(f"{name} needs to be a non-empty list")
+    if np.any(np.diff(nodes) <= 0):
+        raise ValueError(f"{name} need to be unique and increasing, got {nodes}")
+    if period is not None and nodes[-1] - nodes[0] >= period:
+        raise ValueError(f"{name} need to lie within {period}, got {nodes}")
+    return nodes
+
+
+def interpolation_weights(x, nodes, period=None):
+    """
+    Linear interpolation weights of `x` between the two neighbouring nodes.
+    Outside of the nodes, the closest node gets the full weight.
+    If `period` is given, the nodes wrap around (e.g. azimuth with 360).
+    Returns a dict node index -> weight.
+    """
+    order = np.argsort(nodes)
+    nodes = np.asarray(nodes)[order]
+    if len(nodes) == 1:
+        return {order[0]: 1.0}
+    if period is None:
+        if x <= nodes[0]:
+            return {order[0]: 1.0}
+        if x >= nodes[-1]:
+            return {order[-1]: 1.0}
+        upper = np.searchsorted(nodes, x, side="right")
+        lower = upper - 1
+        distance = nodes[upper] - nodes[lower]
+        offset = x - nodes[lower]
+    else:
+        x = nodes[0] + (x - nodes[0]) % period
+        upper = np.searchsorted(nodes, x, side="right") % len(nodes)
+        lower = upper - 1
+        distance = (nodes[upper] - nodes[lower]) % period
+        offset = (x - nodes[lower]) % period
+    weight = offset / distance
+    weights = {order[lower]: 1 - weight, order[upper]: weight}
+    return {node: w for node, w in weights.items() if w > 0}
+
+
+def grid_interpolation_weights(available, cos_zenith, azimuth, cz_nodes, az_nodes):
+    """
+    Weights of the (cos zenith, azimuth) grid nodes for a single run.
+    Only nodes in `available` (tuples of node indices) are used:
+    The cos zenith interpolation is done per azimuth node,
+    azimuth nodes without any model are skipped.
+    Returns a dict (cz index, az index) -> weight.
+    """
+    available = set(available)
+    az_idx = [j for j in range(len(az_nodes)) if any(a[1] == j for a in available)]
+    weights = {}
+    az_weights = interpolation_weights(azimuth, az_nodes[az_idx], period=360)
+    for k, az_weight in az_weights.items():
+        j = az_idx[k]
+        cz_idx = [i for i in range(len(cz_nodes)) if (i, j) in available]
+        cz_weights = interpolation_weights(cos_zenith, cz_nodes[cz_idx])
+        for m, cz_weight in cz_weights.items():
+            weights[cz_idx[m], j] = az_weight * cz_weight
+    return weights
+
+
+def scaled_features(columns, scales):
+    """
+    Features of the runs for `find_nearest_runs` with shape (n_runs, n_features).
+    Each column is divided by its scale, so that a difference of one scale
+    counts the same for all of them. Azimuth (in deg) wraps around,
+    so it is represented by the position on the unit circle.
+    """
+    features = []
+    for name, scale in scales.items():
+        values = np.asarray(columns[name], dtype=float)
+        if name == "azimuth":
+            az = np.deg2rad(values)
+            scale_rad = np.deg2rad(scale)
+            features += [np.cos(az) / scale_rad, np.sin(az) / scale_rad]
+        else:
+            features.append(values / scale)
+    return np.column_stack(features)
+
+
+def find_nearest_runs(features, livetime, n_runs, min_livetime=0):
+    """
+    Find the `n_runs` nearest runs (including the run itself) for every run.
+    If these do not add up to `min_livetime`, the next nearest runs are added
+    until they do.
+    Returns a list with the sorted indices of the selected runs for every run.
+    """
+    tree = cKDTree(features)
+    n_total = len(features)
+    k = min(n_runs, n_total)
+    _, nearest = tree.query(features, k=k)
+    nearest = nearest.reshape(n_total, k)
+    neighbours = []
+    for i, selected in enumerate(nearest):
+        idx = selected
+        # Only runs short on livetime need a second, larger query
+        while livetime[idx].sum() < min_livetime and len(idx) < n_total:
+            _, candidates = tree.query(features[i], k=min(2 * len(idx), n_total))
+            cumulative = np.cumsum(livetime[candidates])
+            n_needed = np.searchsorted(cumulative, min_livetime) + 1
+            idx = candidates[: max(k, n_needed)]
+        neighbours.append(tuple(sorted(idx)))
+    return neighbours
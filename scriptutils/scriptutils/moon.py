@@ -0,0 +1,128 @@
+import logging
+from pathlib import Path
+
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import AltAz, EarthLocation, get_body, get_sun
+from astropy.time import Time
+
+log = logging.getLogger(__name__)
+
+LA_PALMA = EarthLocation.from_geodetic(
+    u.Quantity(-17.89139, u.deg),
+    u.Quantity(28.76139, u.deg),
+    height=u.Quantity(2184, u.m),
+)
+
+
+def moon_altitude_illumination(time, location=LA_PALMA):
+    """
+    Altitude in deg and illuminated fraction of the moon, computed with astropy.
+    The illumination is the same as `astroplan.moon.moon_illumination`.
+    """
+    moon = get_body("moon", time, location=location)
+    altitude = moon.transform_to(AltAz(obstime=time, location=location)).alt
+    sun = get_sun(time)
+    elongation = sun.separation(moon)
+    phase_angle = np.arctan2(
+        sun.distance * np.sin(elongation),
+        moon.distance - sun.distance * np.cos(elongation),
+    )
+    illumination = (1 + np.cos(phase_angle)) / 2
+    return altitude.to_value(u.deg), illumination.to_value(u.one)
+
+
+class MoonEphemeris:
+    """
+    Moon altitude and illumination interpolated on a coarse time grid.
+
+    Each call computes the missing grid points between the first
+    and the last requested time at once.
+    With a ``cache`` file, the grid is kept between calls, so
+    the ephemeris of a time is calculated once.
+    The interpolation error with the default resolution of 5 min
+    is below 0.05 deg in altitude.
+
+    Parameters
+    ----------
+    location: astropy.coordinates.EarthLocation
+        Location of the observer.
+    resolution: astropy.units.Quantity
+        Spacing of the time grid.
+    cache: str or Path
+        npz file to load and store the grid.
+    """
+
+    def __init__(self, location=LA_PALMA, resolution=5 * u.min, cache=None):
+        self.location = location
+        self.resolution = u.Quantity(resolution).to_value(u.s)
+        self.cache = Path(cache) if cache is not None else None
+        self.grid = np.array([], dtype=np.int64)
+        self.altitude = np.array([])
+        self.illumination = np.array([])
+        if self.cache is not None and self.cache.exists():
+            self._load()
+
+    def _key(self):
+        return np.array(
+            [
+                *self.location.geodetic.lon.deg.ravel(),
+                *self.location.geodetic.lat.deg.ravel(),
+                *self.location.geodetic.height.to_value(u.m).ravel(),
+                self.resolution,
+            ],
+        )
+
+    def _load(self):
+        with np.load(self.cache) as f:
+            if not np.array_equal(f["key"], self._key()):
+                log.info(f"Ignoring moon ephemeris {self.cache} of another setup")
+                return
+            self.grid = f["grid"]
+            self.altitude = f["altitude"]
+            self.illumination = f["illumination"]
+        log.debug(f"Loaded {len(self.grid)} moon ephemeris points from {self.cache}")
+
+    def _save(self):
+        self.cache.parent.mkdir(exist_ok=True, parents=True)
+        # np.savez appends .npz to paths without it, a file keeps the path as is
+        with self.cache.open("wb") as f:
+            np.savez(
+                f,
+                key=self._key(),
+                grid=self.grid,
+                altitude=self.altitude,
+                illumination=self.illumination,
+            )
+
+    def _update_grid(self, unix):
+        """Compute the missing grid points spanning the times (unix seconds)"""
+        idx = np.floor(unix / self.resolution).astype(np.int64)
+        required = np.arange(idx.min(), idx.max() + 2)
+        missing = np.setdiff1d(required, self.grid)
+        if len(missing) == 0:
+            return
+        log.info(f"Computing moon ephemeris for {len(missing)} grid points")
+        altitude, illumination = moon_altitude_illumination(
+            Time(missing * self.resolution, format="unix", scale="utc"),
+            self.location,
+        )
+        grid = np.concatenate([self.grid, missing])
+        order = np.argsort(grid)
+        self.grid = grid[order]
+        self.altitude = np.concatenate([self.altitude, altitude])[order]
+        self.illumination = np.concatenate([self.illumination, illumination])[order]
+        if self.cache is not None:
+            self._save()
+
+    def __call__(self, time):
+        """Altitude in deg and illuminated fraction of the moon at ``time``"""
+        unix = np.atleast_1d(Time(time).unix)
+        if len(unix) == 0:
+            return np.array([]), np.array([])
+        self._update_grid(unix)
+        grid = self.grid * self.resolution
+        altitude = np.interp(unix, grid, self.altitude)
+        illumination = np.interp(unix, grid, self.illumination)
+        shape = np.shape(time)
+        return altitude.reshape(shape), illumination.reshape(shape)
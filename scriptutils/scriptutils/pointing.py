@@ -0,0 +1,231 @@
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import AltAz, SkyCoord
+
+
+def _to_vectors(lon, lat):
+    """Unit vectors (..., 3) from longitude and latitude in rad"""
+    cos_lat = np.cos(lat)
+    return np.stack(
+        [cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)],
+        axis=-1,
+    )
+
+
+def _from_vectors(vectors):
+    """Inverse of `_to_vectors`, returns longitude in [0, 2pi) and latitude in rad"""
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+    lon = np.arctan2(y, x) % (2 * np.pi)
+    lat = np.arctan2(z, np.hypot(x, y))
+    return lon, lat
+
+
+def _output_buffers(out, *args):
+    if out is None:
+        shape = np.broadcast_shapes(*(np.shape(a) for a in args))
+        return np.empty(shape), np.empty(shape)
+    return out
+
+
+def sky_to_fov(lon, lat, lon_pnt, lat_pnt, out=None):
+    """
+    Transform sky coordinates to field-of-view coordinates.
+
+    Same as `gammapy.utils.coordinates.sky_to_fov`, but on plain float arrays
+    in rad. The result is written to ``out``, a tuple of two preallocated arrays,
+    which may be ``lon`` and ``lat`` themselves to transform them in place.
+    """
+    fov_lon, fov_lat = _output_buffers(out, lon, lat, lon_pnt, lat_pnt)
+    cos_lat = np.cos(lat)
+    sin_lat = np.sin(lat)
+    cos_pnt = np.cos(lat_pnt)
+    sin_pnt = np.sin(lat_pnt)
+    # Unit vector rotated by -lon_pnt around z, fov_lon holds x
+    np.subtract(lon, lon_pnt, out=fov_lon)
+    y = np.sin(fov_lon)
+    y *= cos_lat
+    np.cos(fov_lon, out=fov_lon)
+    fov_lon *= cos_lat
+    # Rotation by lat_pnt around y
+    np.multiply(fov_lon, sin_pnt, out=fov_lat)
+    np.subtract(sin_lat * cos_pnt, fov_lat, out=fov_lat)
+    fov_lon *= cos_pnt
+    fov_lon += sin_lat * sin_pnt
+    horizontal = np.hypot(fov_lon, y)
+    # The longitude axis is reversed in the FoV system
+    np.arctan2(y, fov_lon, out=fov_lon)
+    np.negative(fov_lon, out=fov_lon)
+    np.arctan2(fov_lat, horizontal, out=fov_lat)
+    return fov_lon, fov_lat
+
+
+def fov_to_sky(lon, lat, lon_pnt, lat_pnt, out=None):
+    """
+    Transform field-of-view coordinates to sky coordinates.
+
+    Same as `gammapy.utils.coordinates.fov_to_sky`, but on plain float arrays
+    in rad, see `sky_to_fov`. The sky longitude is in [0, 2pi).
+    """
+    sky_lon, sky_lat = _output_buffers(out, lon, lat, lon_pnt, lat_pnt)
+    cos_lat = np.cos(lat)
+    sin_lat = np.sin(lat)
+    cos_pnt = np.cos(lat_pnt)
+    sin_pnt = np.sin(lat_pnt)
+    # The longitude axis is reversed in the FoV system
+    y = np.sin(lon)
+    y *= -cos_lat
+    # Rotation by -lat_pnt around y, sky_lon holds x
+    np.cos(lon, out=sky_lon)
+    sky_lon *= cos_lat
+    np.multiply(sky_lon, sin_pnt, out=sky_lat)
+    sky_lat += sin_lat * cos_pnt
+    sky_lon *= cos_pnt
+    sky_lon -= sin_lat * sin_pnt
+    horizontal = np.hypot(sky_lon, y)
+    # Rotation by lon_pnt around z
+    np.arctan2(y, sky_lon, out=sky_lon)
+    sky_lon += lon_pnt
+    np.remainder(sky_lon, 2 * np.pi, out=sky_lon)
+    np.arctan2(sky_lat, horizontal, out=sky_lat)
+    return sky_lon, sky_lat
+
+
+class AltAzTransformCache:
+    """
+    ICRS <-> AltAz transformations around the pointing of one observation.
+
+    The transformation is computed once with astropy on a time grid.
+    For every grid point, it is fitted as a linear map of the unit vectors
+    to the pointing and points up to ``fov_radius`` around it.
+    Transformations at arbitrary times interpolate the maps linearly,
+    which is a lot faster than transforming every coordinate with its
+    own obstime. With the default 10 s grid, the error is a few 0.01 arcsec.
+
+    Parameters
+    ----------
+    pointing: astropy.coordinates.SkyCoord
+        Pointing position of the observation.
+    tstart, tstop: astropy.time.Time
+        Start and stop of the observation.
+    location: astropy.coordinates.EarthLocation
+        Location of the telescope.
+    time_resolution: astropy.units.Quantity
+        Spacing of the time grid.
+    fov_radius: astropy.units.Quantity
+        Radius of the field of view used to fit the maps.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        pointing,
+        tstart,
+        tstop,
+        location,
+        time_resolution=10 * u.s,
+        fov_radius=2 * u.deg,
+    ):
+        self.pointing = pointing.icrs
+        self.location = location
+        self.tstart = tstart
+        duration = (tstop - tstart).to(u.s)
+        n_times = max(int(np.ceil(duration / u.Quantity(time_resolution))), 1) + 1
+        self.time_offsets = np.linspace(0, duration.to_value(u.s), n_times)
+        self.times = tstart + self.time_offsets * u.s
+
+        # The pointing itself and two rings of points around it
+        directions = np.tile(np.arange(0, 360, 45), 2) * u.deg
+        radii = np.repeat([0.5, 1], 8) * u.Quantity(fov_radius)
+        reference = self.pointing.directional_offset_by(
+            np.append(0 * u.deg, directions),
+            np.append(0 * u.deg, radii),
+        )
+        # One transform for all points and grid times
+        shape = (n_times, len(reference))
+        reference_altaz = SkyCoord(
+            np.broadcast_to(reference.ra, shape, subok=True),
+            np.broadcast_to(reference.dec, shape, subok=True),
+            frame="icrs",
+        ).transform_to(
+            AltAz(obstime=self.times[:, np.newaxis], location=self.location),
+        )
+        icrs = _to_vectors(reference.ra.rad, reference.dec.rad)
+        altaz = _to_vectors(reference_altaz.az.rad, reference_altaz.alt.rad)
+        # Least squares linear map (altaz = M @ icrs) for every grid time.
+        # This is mostly a rotation, but a general matrix also absorbs
+        # the scaling of the field of view due to aberration
+        self.matrices = np.einsum("ip,tpj->tji", np.linalg.pinv(icrs), altaz)
+        self.inverse_matrices = np.linalg.inv(self.matrices)
+
+    def matrix(self, time):
+        """Interpolated matrices ICRS -> AltAz with shape (*time.shape, 3, 3)"""
+        idx, weight = self._interpolation_index(time)
+        weight = weight[..., np.newaxis, np.newaxis]
+        return (1 - weight) * self.matrices[idx] + weight * self.matrices[idx + 1]
+
+    def _interpolation_index(self, time):
+        t = (time - self.tstart).to_value(u.s)
+        idx = np.searchsorted(self.time_offsets, t, side="right") - 1
+        idx = np.clip(idx, 0, len(self.time_offsets) - 2)
+        weight = (t - self.time_offsets[idx]) / (
+            self.time_offsets[idx + 1] - self.time_offsets[idx]
+        )
+        return idx, weight
+
+    def _transform(self, vectors, time, inverse=False):
+        # Element wise instead of building a (n, 3, 3) matrix for every coordinate
+        matrices = self.inverse_matrices if inverse else self.matrices
+        idx, weight = self._interpolation_index(time)
+        transformed = np.zeros(np.broadcast_shapes(vectors.shape, idx.shape + (3,)))
+        for i in range(3):
+            for j in range(3):
+                m = matrices[:, i, j]
+                transformed[..., i] += ((1 - weight) * m[idx] + weight * m[idx + 1]) * (
+                    vectors[..., j]
+                )
+        # The result is normalized in _from_vectors
+        return transformed
+
+    def icrs_to_altaz_rad(self, ra, dec, time):
+        """Same as `icrs_to_altaz` on plain float arrays in rad"""
+        return _from_vectors(self._transform(_to_vectors(ra, dec), time))
+
+    def altaz_to_icrs_rad(self, az, alt, time):
+        """Same as `altaz_to_icrs` on plain float arrays in rad"""
+        return _from_vectors(self._transform(_to_vectors(az, alt), time, inverse=True))
+
+    def pointing_altaz_rad(self, time):
+        """Same as `pointing_altaz` on plain float arrays in rad"""
+        return self.icrs_to_altaz_rad(self.pointing.ra.rad, self.pointing.dec.rad, time)
+
+    def icrs_to_altaz(self, ra, dec, time):
+        """
+        Transform ICRS coordinates to AltAz at the given times.
+        Returns azimuth and altitude as quantities in deg.
+        """
+        az, alt = self.icrs_to_altaz_rad(
+            u.Quantity(ra, u.deg).to_value(u.rad),
+            u.Quantity(dec, u.deg).to_value(u.rad),
+            time,
+        )
+        return u.Quantity(az, u.rad).to(u.deg), u.Quantity(alt, u.rad).to(u.deg)
+
+    def altaz_to_icrs(self, az, alt, time):
+        """
+        Transform AltAz coordinates at the given times to ICRS.
+        Returns ra and dec as quantities in deg.
+        """
+        ra, dec = self.altaz_to_icrs_rad(
+            u.Quantity(az, u.deg).to_value(u.rad),
+            u.Quantity(alt, u.deg).to_value(u.rad),
+            time,
+        )
+        return u.Quantity(ra, u.rad).to(u.deg), u.Quantity(dec, u.rad).to(u.deg)
+
+    def pointing_altaz(self, time):
+        """Azimuth and altitude of the pointing at the given times"""
+        return self.icrs_to_altaz(self.pointing.ra, self.pointing.dec, time)
+
+    @classmethod
+    def from_observation(cls, obs, location, **kwargs):
+        """Create the cache for a gammapy observation"""
+        return cls(obs.pointing_radec, obs.tstart, obs.tstop, location, **kwargs)
@@ -0,0 +1,106 @@
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.table import Table
+from astropy.time import Time
+from astropy.utils import iers
+from gammapy.data import DataStore
+from regions import CircleSkyRegion, Regions
+
+from scriptutils.moon import LA_PALMA
+
+SOURCE = SkyCoord(83.633, 22.014, unit=u.deg)
+MJDREF = Time("2019-01-01T00:00:00", scale="utc")
+RUN_DURATION = 5 * u.min
+N_EVENTS = 5000
+
+
+@pytest.fixture(autouse=True, scope="session")
+def _no_iers_download():
+    with iers.conf.set_temp("auto_download", False), iers.conf.set_temp(
+        "auto_max_age",
+        None,
+    ):
+        yield
+
+
+def write_run(path, obs_id, pointing, tstart, rng):
+    """Small DL3 file with events uniformly distributed in the FoV"""
+    n_events = N_EVENTS
+    radec = pointing.directional_offset_by(
+        rng.uniform(0, 360, n_events) * u.deg,
+        2.5 * np.sqrt(rng.uniform(0, 1, n_events)) * u.deg,
+    )
+    t0 = (tstart - MJDREF).to_value(u.s)
+    t1 = t0 + RUN_DURATION.to_value(u.s)
+    time_meta = {
+        "MJDREFI": int(MJDREF.mjd),
+        "MJDREFF": MJDREF.mjd % 1,
+        "TIMESYS": "UTC",
+        "TIMEUNIT": "s",
+        "TIMEREF": "TOPOCENTER",
+    }
+    events = Table()
+    events["EVENT_ID"] = np.arange(n_events)
+    events["TIME"] = u.Quantity(np.sort(rng.uniform(t0, t1, n_events)), u.s)
+    events["RA"] = radec.ra.to(u.deg)
+    events["DEC"] = radec.dec.to(u.deg)
+    events["ENERGY"] = u.Quantity(0.02 * rng.pareto(1.7, n_events) + 0.02, u.TeV)
+    events.meta.update(
+        {
+            "EXTNAME": "EVENTS",
+            "HDUCLASS": "GADF",
+            "HDUCLAS1": "EVENTS",
+            "OBS_ID": obs_id,
+            "RA_PNT": pointing.ra.deg,
+            "DEC_PNT": pointing.dec.deg,
+            "TSTART": t0,
+            "TSTOP": t1,
+            "ONTIME": t1 - t0,
+            "LIVETIME": t1 - t0,
+            "DEADC": 1.0,
+            "GEOLON": LA_PALMA.lon.deg,
+            "GEOLAT": LA_PALMA.lat.deg,
+            "ALTITUDE": LA_PALMA.height.to_value(u.m),
+            "OBS_MODE": "POINTING",
+            "TELESCOP": "CTA-N",
+            "INSTRUME": "LST-1",
+            "RADECSYS": "ICRS",
+            "EQUINOX": 2000.0,
+            **time_meta,
+        },
+    )
+    gti = Table({"START": [t0] * u.s, "STOP": [t1] * u.s})
+    gti.meta.update(
+        {"EXTNAME": "GTI", "HDUCLASS": "GADF", "HDUCLAS1": "GTI", **time_meta},
+    )
+    fits.HDUList(
+        [fits.PrimaryHDU(), fits.table_to_hdu(events), fits.table_to_hdu(gti)],
+    ).writeto(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def data_store(tmp_path_factory):
+    """Three short runs wobbling around the source"""
+    directory = tmp_path_factory.mktemp("dl3")
+    rng = np.random.default_rng(0)
+    tstart = Time("2022-01-15T23:00:00")
+    paths = [
+        write_run(
+            directory / f"dl3_{i:05d}.fits",
+            obs_id=i + 1,
+            pointing=SOURCE.directional_offset_by(90 * i * u.deg, 0.4 * u.deg),
+            tstart=tstart + i * (RUN_DURATION + 1 * u.min),
+            rng=rng,
+        )
+        for i in range(3)
+    ]
+    return DataStore.from_events_files(paths)
+
+
+@pytest.fixture(scope="session")
+def exclusion_regions():
+    return Regions([CircleSkyRegion(SOURCE, 0.3 * u.deg)])
@@ -0,0 +1,151 @@
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import EarthLocation, SkyCoord
+from gammapy.maps import MapAxis
+from regions import CircleSkyRegion
+
+from scriptutils.bkg import ExclusionMapBackgroundMaker
+
+LOCATION = EarthLocation.from_geodetic(-17.89139 * u.deg, 28.76139 * u.deg, 2184 * u.m)
+
+
+def new_maker(counts_per_pixel, seed, **kwargs):
+    e_reco = MapAxis.from_energy_bounds("0.1 TeV", "10 TeV", nbin=3, name="energy")
+    exclusion = [CircleSkyRegion(SkyCoord(83.63, 22.01, unit="deg"), 0.3 * u.deg)]
+    maker = ExclusionMapBackgroundMaker(
+        e_reco,
+        LOCATION,
+        exclusion,
+        nbins=16,
+        adaptive_max_level=3,
+        gaussian_smoothing_3d=0,
+        **kwargs,
+    )
+    rng = np.random.default_rng(seed)
+    maker.time_map_eff = u.Quantity(np.ones((16, 16)), u.h)
+    maker.counts_map_eff = rng.poisson(counts_per_pixel, (3, 16, 16)).astype(float)
+    return maker
+
+
+def test_adaptive_resample_factor():
+    factors = [
+        new_maker(10, 0, adaptive_min_counts=min_counts).adaptive_resample_factor()
+        for min_counts in [None, 20, 1e6]
+    ]
+    # No adaptive binning, blocks of at least 2x2 pixels and only 8x8 blocks
+    assert factors == [1, 2, 8]
+
+
+def test_grid_nodes_with_adaptive_binning():
+    """Nodes with different statistics, as in the cos_zenith_grid matching"""
+    makers = [
+        new_maker(1000, 1, adaptive_min_counts=100),
+        new_maker(10, 2, adaptive_min_counts=100),
+    ]
+    factors = [maker.adaptive_resample_factor() for maker in makers]
+    assert factors[0] < factors[1]
+
+    # Data driven resampling gives incompatible models
+    shapes = {maker.get_bg_3d().data.shape for maker in makers}
+    assert len(shapes) > 1
+
+    factor = min(factors)
+    models = [maker.get_bg_3d(resample_factor=factor) for maker in makers]
+    assert models[0].data.shape == models[1].data.shape == (3, 16, 16)
+    assert models[0].axes == models[1].axes
+    blended = 0.3 * models[0].quantity + 0.7 * models[1].quantity
+    assert np.all(np.isfinite(blended))
+
+    # Both resampled the same way as with their own factor
+    coarse = makers[1].get_bg_3d(resample_factor=factors[1])
+    assert coarse.data.shape == (3, 16 // factors[1], 16 // factors[1])
+    assert coarse.axes == makers[1].get_bg_3d().axes
+
+
+def test_resample_factor_must_divide_nbins():
+    with pytest.raises(ValueError, match="not divisible"):
+        new_maker(10, 0).get_bg_3d(resample_factor=3)
+
+
+def new_run_maker(exclusion_regions):
+    e_reco = MapAxis.from_energy_bounds("20 GeV", "20 TeV", nbin=5, name="energy")
+    return ExclusionMapBackgroundMaker(
+        e_reco,
+        LOCATION,
+        exclusion_regions,
+        nbins=20,
+        n_offset_bins=5,
+        offset_max="2 deg",
+    )
+
+
+def summed_maps(maker):
+    return (
+        maker.counts_map_eff,
+        maker.counts_map_obs,
+        maker.time_map_eff.to_value(u.h),
+        maker.time_map_obs.to_value(u.h),
+    )
+
+
+def assert_same_maps(maker, expected):
+    for a, b in zip(summed_maps(maker), summed_maps(expected)):
+        np.testing.assert_allclose(a, b, rtol=1e-12, atol=0)
+
+
+def test_partial_fit(data_store, exclusion_regions):
+    obs_ids = data_store.obs_ids[:2]
+    expected = new_run_maker(exclusion_regions)
+    expected.run(data_store, obs_ids)
+
+    maker = new_run_maker(exclusion_regions)
+    for obs in data_store.get_observations(obs_ids, required_irf=[]):
+        maker.partial_fit(obs)
+    maker.finalize()
+    assert_same_maps(maker, expected)
+    np.testing.assert_allclose(maker.bg_rate, expected.bg_rate, rtol=1e-12)
+
+
+def test_merge(data_store, exclusion_regions):
+    expected = new_run_maker(exclusion_regions)
+    expected.run(data_store)
+
+    first = new_run_maker(exclusion_regions)
+    first.run(data_store, data_store.obs_ids[:1])
+    second = new_run_maker(exclusion_regions)
+    second.run(data_store, data_store.obs_ids[1:])
+    first.merge(second).finalize()
+    assert_same_maps(first, expected)
+    np.testing.assert_allclose(first.bg_rate, expected.bg_rate, rtol=1e-12)
+
+    other_binning = ExclusionMapBackgroundMaker(
+        first.e_reco,
+        LOCATION,
+        exclusion_regions,
+        nbins=10,
+    )
+    with pytest.raises(ValueError, match="different"):
+        first.merge(other_binning)
+
+
+def test_add_remove_maps(data_store, exclusion_regions):
+    maker = new_run_maker(exclusion_regions)
+    cached_maps = maker._fill_all_maps(data_store)
+    a, b, c = data_store.obs_ids
+
+    maker.add_maps(cached_maps, [a, b])
+    expected = new_run_maker(exclusion_regions)
+    expected.run(data_store, [a, b], cached_maps=cached_maps)
+    assert_same_maps(maker, expected)
+
+    # Sliding the window by one run and back restores the sums
+    maker.add_maps(cached_maps, [c])
+    maker.remove_maps(cached_maps, [a])
+    expected_bc = new_run_maker(exclusion_regions)
+    expected_bc.run(data_store, [b, c], cached_maps=cached_maps)
+    assert_same_maps(maker, expected_bc)
+    maker.add_maps(cached_maps, [a])
+    maker.remove_maps(cached_maps, [c])
+    assert_same_maps(maker, expected)
+    np.testing.assert_array_equal(maker.counts_map_eff, expected.counts_map_eff)
@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from astropy.time import Time
+
+from scriptutils.datacheck import load_per_run_columns, per_run_columns
+
+
+class CountingEphemeris:
+    """Fake ephemeris recording the times it is evaluated at"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, time):
+        self.calls.append(time.unix)
+        return -10 * np.ones(len(time)), 0.5 * np.ones(len(time))
+
+
+@pytest.fixture()
+def config():
+    return SimpleNamespace(
+        source_ra_deg=83.633,
+        source_dec_deg=22.014,
+        max_zenith_deg=50.0,
+    )
+
+
+@pytest.fixture()
+def runsummary():
+    n_runs = 5
+    return Table(
+        {
+            "runnumber": np.arange(1000, 1000 + n_runs),
+            "time": Time("2022-01-15T23:00:00").unix + 1800.0 * np.arange(n_runs),
+            "mean_ra": np.full(n_runs, 83.633),
+            "mean_dec": np.full(n_runs, 22.414),
+            "mean_altitude": np.deg2rad([70, 60, 50, 30, 65]),
+            "num_pedestals": [100.0, np.nan, 100.0, 100.0, 100.0],
+        },
+    )
+
+
+def test_load_per_run_columns_cache(tmp_path, runsummary, config):
+    cache = tmp_path / "cache.h5"
+    ephemeris = CountingEphemeris()
+    expected = load_per_run_columns(runsummary, config, cache, ephemeris)
+    assert list(expected["mask_pedestals_ok"]) == [True, False, True, True, True]
+    assert list(expected["mask_zenith"]) == [True, True, True, False, True]
+    assert len(ephemeris.calls[0]) == len(runsummary)
+
+    # Only the changed run is recomputed, the others come from the cache
+    runsummary["mean_altitude"][3] = np.deg2rad(80)
+    ephemeris = CountingEphemeris()
+    columns = load_per_run_columns(runsummary, config, cache, ephemeris)
+    np.testing.assert_array_equal(ephemeris.calls, [[runsummary["time"][3]]])
+    assert list(columns["mask_zenith"]) == [True] * len(runsummary)
+    for name in per_run_columns:
+        np.testing.assert_array_equal(
+            np.delete(columns[name], 3),
+            np.delete(expected[name], 3),
+        )
+
+    ephemeris = CountingEphemeris()
+    load_per_run_columns(runsummary, config, cache, ephemeris)
+    assert ephemeris.calls == []
+
+
+def test_load_per_run_columns_empty_cache(tmp_path, runsummary, config):
+    cache = tmp_path / "cache.h5"
+    load_per_run_columns(runsummary[:0], config, cache, CountingEphemeris())
+    assert len(Table.read(cache, path="data")) == 0
+
+    ephemeris = CountingEphemeris()
+    columns = load_per_run_columns(runsummary, config, cache, ephemeris)
+    assert len(ephemeris.calls[0]) == len(runsummary)
+    assert columns.keys() == set(per_run_columns)
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+from scriptutils.matching import (
+    check_nodes,
+    find_nearest_runs,
+    grid_interpolation_weights,
+    interpolation_weights,
+    scaled_features,
+)
+
+
+def test_interpolation_weights_inside():
+    weights = interpolation_weights(0.75, [0.5, 0.7, 0.8, 1.0])
+    assert weights.keys() == {1, 2}
+    assert weights[1] == pytest.approx(0.5)
+    assert weights[2] == pytest.approx(0.5)
+
+    # Nodes do not need to be sorted, the indices refer to the given order
+    weights = interpolation_weights(0.72, [1.0, 0.8, 0.7, 0.5])
+    assert weights[2] == pytest.approx(0.8)
+    assert weights[1] == pytest.approx(0.2)
+
+
+def test_interpolation_weights_on_node():
+    assert interpolation_weights(0.7, [0.5, 0.7, 1.0]) == {1: 1.0}
+
+
+def test_interpolation_weights_clamped():
+    assert interpolation_weights(0.1, [0.5, 0.7, 1.0]) == {0: 1.0}
+    assert interpolation_weights(1.2, [0.5, 0.7, 1.0]) == {2: 1.0}
+    assert interpolation_weights(0.1, [0.9]) == {0: 1.0}
+
+
+def test_interpolation_weights_periodic():
+    nodes = [0, 90, 180, 270]
+    weights = interpolation_weights(45, nodes, period=360)
+    assert weights[0] == pytest.approx(0.5)
+    assert weights[1] == pytest.approx(0.5)
+
+    # Between the last and the first node
+    weights = interpolation_weights(330, nodes, period=360)
+    assert weights.keys() == {3, 0}
+    assert weights[3] == pytest.approx(1 / 3)
+    assert weights[0] == pytest.approx(2 / 3)
+    assert interpolation_weights(-30, nodes, period=360) == pytest.approx(weights)
+    assert interpolation_weights(690, nodes, period=360) == pytest.approx(weights)
+
+
+def test_grid_interpolation_weights():
+    cz_nodes = np.array([0.5, 0.7, 0.9])
+    az_nodes = np.array([0.0, 180.0])
+    available = [(i, j) for i in range(3) for j in range(2)]
+    weights = grid_interpolation_weights(available, 0.8, 90, cz_nodes, az_nodes)
+    assert weights.keys() == {(1, 0), (2, 0), (1, 1), (2, 1)}
+    for w in weights.values():
+        assert w == pytest.approx(0.25)
+
+    # Wrap around in azimuth and clamped in cos zenith
+    weights = grid_interpolation_weights(available, 0.95, 315, cz_nodes, az_nodes)
+    assert weights == pytest.approx({(2, 0): 0.75, (2, 1): 0.25})
+
+
+def test_grid_interpolation_weights_missing_nodes():
+    cz_nodes = np.array([0.5, 0.7, 0.9])
+    az_nodes = np.array([0.0, 180.0])
+    # No model at (1, 0), an azimuth node without any model is skipped
+    available = [(0, 0), (2, 0)]
+    weights = grid_interpolation_weights(available, 0.8, 90, cz_nodes, az_nodes)
+    assert weights == pytest.approx({(0, 0): 0.25, (2, 0): 0.75})
+    assert sum(weights.values()) == pytest.approx(1)
+
+
+def test_check_nodes():
+    np.testing.assert_array_equal(check_nodes([0.5, 0.9], "nodes"), [0.5, 0.9])
+    for nodes in ([0.9, 0.9, 0.95], [0.9, 0.5], []):
+        with pytest.raises(ValueError, match="nodes"):
+            check_nodes(nodes, "nodes")
+    with pytest.raises(ValueError, match="within 360"):
+        check_nodes([0, 180, 360], "nodes", period=360)
+
+
+def test_scaled_features():
+    columns = {
+        "cos_zenith": [0.9, 0.95, 0.9, 0.9],
+        "azimuth": [350, 350, 10, 170],
+        "date": [0, 0, 0, 60],
+    }
+    scales = {"cos_zenith": 0.05, "azimuth": 20, "date": 60}
+    features = scaled_features(columns, scales)
+    assert features.shape == (4, 4)
+    distance = np.linalg.norm(features - features[0], axis=1)
+    # One scale in cos zenith
+    assert distance[1] == pytest.approx(1)
+    # Azimuth wraps around, 20 deg is about one scale
+    assert distance[2] == pytest.approx(1, rel=0.02)
+    assert distance[3] > distance[2]
+
+
+def test_find_nearest_runs():
+    features = np.array([[0.0], [1.0], [3.0], [6.0], [10.0]])
+    livetime = np.ones(5)
+    neighbours = find_nearest_runs(features, livetime, n_runs=2)
+    assert neighbours == [(0, 1), (0, 1), (1, 2), (2, 3), (3, 4)]
+
+    # More runs requested than available
+    neighbours = find_nearest_runs(features, livetime, n_runs=10)
+    assert neighbours == [(0, 1, 2, 3, 4)] * 5
+
+
+def test_find_nearest_runs_min_livetime():
+    features = np.array([[0.0], [1.0], [3.0], [6.0], [10.0]])
+    livetime = np.array([0.5, 0.5, 2.0, 1.0, 4.0])
+    min_livetime = 2
+    neighbours = find_nearest_runs(features, livetime, 1, min_livetime)
+    # Runs are added in the order of their distance until there is enough livetime
+    assert neighbours == [(0, 1, 2), (0, 1, 2), (2,), (2, 3), (4,)]
+    for idx in neighbours:
+        assert livetime[list(idx)].sum() >= min_livetime
+
+    # Not enough livetime in total, all runs are used
+    neighbours = find_nearest_runs(features, livetime, n_runs=1, min_livetime=100)
+    assert neighbours == [(0, 1, 2, 3, 4)] * 5
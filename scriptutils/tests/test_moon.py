@@ -0,0 +1,40 @@
+import astropy.units as u
+import numpy as np
+from astropy.time import Time
+
+from scriptutils.moon import MoonEphemeris, moon_altitude_illumination
+
+# Interpolation error with the default 5 min grid, see MoonEphemeris
+ALTITUDE_TOLERANCE = 0.05
+
+
+def test_moon_ephemeris():
+    tstart = Time("2022-01-15T20:00:00")
+    time = tstart + np.array([0, 20, 250, 600]) * u.min
+    ephemeris = MoonEphemeris()
+    altitude, illumination = ephemeris(time)
+    expected_altitude, expected_illumination = moon_altitude_illumination(time)
+    np.testing.assert_allclose(altitude, expected_altitude, atol=ALTITUDE_TOLERANCE)
+    np.testing.assert_allclose(illumination, expected_illumination, atol=1e-3)
+
+    # The grid spans the queried times once, without gaps
+    assert np.all(np.diff(ephemeris.grid) == 1)
+    grid = ephemeris.grid * ephemeris.resolution
+    assert grid[0] <= time.unix.min()
+    assert grid[-1] >= time.unix.max()
+
+    altitude, illumination = ephemeris(Time([], format="unix"))
+    assert len(altitude) == len(illumination) == 0
+
+
+def test_moon_ephemeris_cache(tmp_path):
+    cache = tmp_path / "moon" / "ephemeris"
+    time = Time("2022-01-15T20:00:00") + np.arange(3) * u.h
+    expected = MoonEphemeris(cache=cache)(time)
+    # The cache is written to the given path, without appending .npz
+    assert [p.name for p in cache.parent.iterdir()] == ["ephemeris"]
+
+    ephemeris = MoonEphemeris(cache=cache)
+    grid = ephemeris.grid.copy()
+    np.testing.assert_array_equal(ephemeris(time), expected)
+    np.testing.assert_array_equal(ephemeris.grid, grid)
@@ -0,0 +1,121 @@
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import AltAz, SkyCoord
+from astropy.time import Time
+from gammapy.utils import coordinates
+
+from scriptutils.moon import LA_PALMA
+from scriptutils.pointing import AltAzTransformCache, fov_to_sky, sky_to_fov
+
+# Error of the cache with the default 10 s grid, see AltAzTransformCache
+CACHE_TOLERANCE = 0.1 * u.arcsec
+
+
+def wrapped(angle):
+    """Angle difference in (-pi, pi]"""
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+@pytest.fixture()
+def fov_coordinates():
+    rng = np.random.default_rng(0)
+    n = 1000
+    lon_pnt = rng.uniform(0, 2 * np.pi, n)
+    lat_pnt = rng.uniform(-1.5, 1.5, n)
+    lon = lon_pnt + rng.uniform(-0.1, 0.1, n) / np.cos(lat_pnt)
+    lat = np.clip(lat_pnt + rng.uniform(-0.1, 0.1, n), -1.5, 1.5)
+    return lon % (2 * np.pi), lat, lon_pnt, lat_pnt
+
+
+def test_sky_to_fov(fov_coordinates):
+    lon, lat, lon_pnt, lat_pnt = fov_coordinates
+    expected_lon, expected_lat = coordinates.sky_to_fov(
+        *(u.Quantity(x, u.rad) for x in fov_coordinates),
+    )
+    fov_lon, fov_lat = sky_to_fov(lon, lat, lon_pnt, lat_pnt)
+    np.testing.assert_allclose(
+        wrapped(fov_lon - expected_lon.to_value(u.rad)),
+        0,
+        atol=1e-12,
+    )
+    np.testing.assert_allclose(fov_lat, expected_lat.to_value(u.rad), atol=1e-12)
+
+
+def test_fov_to_sky(fov_coordinates):
+    _, _, lon_pnt, lat_pnt = fov_coordinates
+    rng = np.random.default_rng(1)
+    fov_lon = rng.uniform(-0.05, 0.05, len(lon_pnt))
+    fov_lat = rng.uniform(-0.05, 0.05, len(lon_pnt))
+    expected_lon, expected_lat = coordinates.fov_to_sky(
+        *(u.Quantity(x, u.rad) for x in (fov_lon, fov_lat, lon_pnt, lat_pnt)),
+    )
+    lon, lat = fov_to_sky(fov_lon, fov_lat, lon_pnt, lat_pnt)
+    assert np.all((lon >= 0) & (lon < 2 * np.pi))
+    np.testing.assert_allclose(
+        wrapped(lon - expected_lon.to_value(u.rad)),
+        0,
+        atol=1e-12,
+    )
+    np.testing.assert_allclose(lat, expected_lat.to_value(u.rad), atol=1e-12)
+
+
+def test_fov_roundtrip_in_place(fov_coordinates):
+    lon, lat, lon_pnt, lat_pnt = fov_coordinates
+    out = lon.copy(), lat.copy()
+    fov_lon, fov_lat = sky_to_fov(*out, lon_pnt, lat_pnt, out=out)
+    assert fov_lon is out[0]
+    assert fov_lat is out[1]
+    np.testing.assert_array_equal(
+        np.stack([fov_lon, fov_lat]),
+        np.stack(sky_to_fov(lon, lat, lon_pnt, lat_pnt)),
+    )
+    sky_lon, sky_lat = fov_to_sky(fov_lon, fov_lat, lon_pnt, lat_pnt, out=out)
+    np.testing.assert_allclose(wrapped(sky_lon - lon), 0, atol=1e-12)
+    np.testing.assert_allclose(sky_lat, lat, atol=1e-12)
+
+
+@pytest.fixture()
+def cache():
+    pointing = SkyCoord(83.633, 22.014, unit=u.deg)
+    tstart = Time("2022-01-15T23:00:00")
+    return AltAzTransformCache(pointing, tstart, tstart + 20 * u.min, LA_PALMA)
+
+
+@pytest.fixture()
+def cache_coordinates(cache):
+    rng = np.random.default_rng(2)
+    n = 500
+    radec = cache.pointing.directional_offset_by(
+        rng.uniform(0, 360, n) * u.deg,
+        2 * np.sqrt(rng.uniform(0, 1, n)) * u.deg,
+    )
+    time = cache.tstart + rng.uniform(0, cache.time_offsets[-1], n) * u.s
+    return radec, time
+
+
+def test_cache_icrs_to_altaz(cache, cache_coordinates):
+    radec, time = cache_coordinates
+    expected = radec.transform_to(AltAz(obstime=time, location=LA_PALMA))
+    az, alt = cache.icrs_to_altaz(radec.ra, radec.dec, time)
+    altaz = SkyCoord(az, alt, frame=expected.frame)
+    assert np.all(altaz.separation(expected) < CACHE_TOLERANCE)
+
+    az, alt = cache.icrs_to_altaz_rad(radec.ra.rad, radec.dec.rad, time)
+    np.testing.assert_allclose(az, expected.az.rad, atol=1e-6)
+    np.testing.assert_allclose(alt, expected.alt.rad, atol=1e-6)
+
+
+def test_cache_altaz_to_icrs(cache, cache_coordinates):
+    radec, time = cache_coordinates
+    altaz = radec.transform_to(AltAz(obstime=time, location=LA_PALMA))
+    ra, dec = cache.altaz_to_icrs(altaz.az, altaz.alt, time)
+    assert np.all(SkyCoord(ra, dec).separation(radec) < CACHE_TOLERANCE)
+
+
+def test_cache_pointing_altaz(cache):
+    time = cache.tstart + np.linspace(0, cache.time_offsets[-1], 50) * u.s
+    expected = cache.pointing.transform_to(AltAz(obstime=time, location=LA_PALMA))
+    az, alt = cache.pointing_altaz(time)
+    altaz = SkyCoord(az, alt, frame=expected.frame)
+    assert np.all(altaz.separation(expected) < CACHE_TOLERANCE)
@@ -1,9 +1,12 @@
 import json
 import os
+import sqlite3
+from contextlib import closing
 from pathlib import Path
 
 # "Main" paths. Everuthing else is relative to these
 scripts_dir = Path("scripts")
+scriptutils_dir = Path("scriptutils")
 env_dir = Path("workflow/envs")
 config_dir = Path(config.get("config_dir", "../lst-analysis-config"))
 main_config_path = (config_dir / "lst_agn.json").absolute()
@@ -79,9 +82,10 @@ SCRIPTS = {
 # TODO This is the most critical part as the further evaluation depends on this checkpoint
 # Have to make sure this works as expected
 def RUN_IDS(wildcards):
-    with open(checkpoints.run_ids.get(**wildcards).output.runlist, "r") as f:
-        runs = json.load(f)
-    return sorted(set(chain(*runs.values())))
+    catalog = checkpoints.run_catalog.get(**wildcards).output.catalog
+    with closing(sqlite3.connect(catalog)) as con:
+        rows = con.execute("SELECT run_id_str FROM runs WHERE selected").fetchall()
+    return sorted(run_id for (run_id,) in rows)
 
 
 def MC_NODES(wildcards):
@@ -190,12 +194,3 @@ def IRF_FILES(wildcards):
         for plot in dl4_plot_types
     ]
 
-
-def BKG_FILES(wildcards):
-    ids = RUN_IDS(wildcards)
-    out = Path(OUTDIRS["dl3"])
-    return [
-        out / f"{wildcards.analysis}/bkg_{run_id}.fits.gz"
-        for run_id in ids
-        for plot in dl4_plot_types
-    ]
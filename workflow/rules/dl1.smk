@@ -22,7 +22,7 @@ localrules:
     runlist,
     select_datasets,
     merge_datachecks,
-    run_ids,
+    run_catalog,
     data_check,
 
 
@@ -48,12 +48,14 @@ rule merge_datachecks:
     input:
         data=out / "runlist.csv",
         script=scripts / "merge-datachecks.py",
+    params:
+        cache=out / "cache/dl1-datachecks.h5",
     conda:
         env
     log:
         out / "merge_datacheck.log",
     shell:
-        "python {input.script} {input.data} {output.output} --log-file {log}"
+        "python {input.script} {input.data} {output.output} --cache {params.cache} --log-file {log}"
 
 
 rule data_check:
@@ -66,6 +68,9 @@ rule data_check:
         datachecks=out / "dl1-datachecks-merged.h5",
         config=config,
         script=scripts / "data-check.py",
+    params:
+        cache=out / "cache/dl1-datachecks-per-run.h5",
+        moon_ephemeris=out / "cache/moon-ephemeris.npz",
     conda:
         env
     log:
@@ -79,26 +84,30 @@ rule data_check:
         --output-runlist {output.runlist} \
         --output-datachecks {output.datachecks} \
         --output-config {output.config} \
+        --cache {params.cache} \
+        --moon-ephemeris {params.moon_ephemeris} \
         --log-file {log}"
 
 
-checkpoint run_ids:
+checkpoint run_catalog:
     output:
-        runlist=out / "runs.json",
+        catalog=out / "runs.sqlite",
     input:
-        data=out / "runlist-checked.csv",
-        config=config,
-        script=scripts / "create-night-run-list.py",
+        runlist=out / "runlist.csv",
+        runlist_checked=out / "runlist-checked.csv",
+        datachecks=out / "dl1-datachecks-masked.h5",
+        script=scripts / "build-run-catalog.py",
     conda:
         env
     log:
-        out / "check_runlist.log",
+        out / "run_catalog.log",
     shell:
         "python \
         {input.script} \
-        {input.data} \
-        {output} \
-        -c {input.config} \
+        --runlist {input.runlist} \
+        --runlist-checked {input.runlist_checked} \
+        --datachecks {input.datachecks} \
+        --output-path {output} \
         --log-file {log}"
 
 
@@ -106,8 +115,7 @@ checkpoint link_runs:
     output:
         dl1 / "runs-linked.txt",
     input:
-        runs=out / "runs.json",
-        datacheck=out / "dl1-datachecks-masked.h5",
+        catalog=out / "runs.sqlite",
         script=scripts / "link-runs.py",
     params:
         dl1=dl1,
@@ -118,7 +126,7 @@ checkpoint link_runs:
     shell:
         "python \
         {input.script} \
-        --runs {input.runs} \
+        --catalog {input.catalog} \
         --dl1-link-dir {params.dl1} \
         --log-file {log} \
         --output-path {output}"
@@ -148,8 +156,7 @@ rule gather_run_pointings:
     output:
         out / "run-pointings.csv",
     input:
-        runs=out / "runs.json",
-        datacheck=out / "dl1-datachecks-masked.h5",
+        catalog=out / "runs.sqlite",
         script=scripts / "gather-run-pointings.py",
     conda:
         env
@@ -157,8 +164,7 @@ rule gather_run_pointings:
         out / "run_pointings.log",
     shell:
         "python {input.script} \
-        --runs {input.runs} \
-        --runsummary {input.datacheck} \
+        --catalog {input.catalog} \
         --output {output} \
         --log-file {log} "
 
@@ -53,42 +53,69 @@ rule dl2_to_dl3:
         """
 
 
-rule calc_count_maps:
+rule calc_count_maps_run:
     output:
-        dl3 / "{analysis}/bkg_cached_maps.pkl",
+        dl3 / "{analysis}/bkg_maps/{run_id}.npz",
     input:
-        runs=DL3_FILES,
+        run=dl3 / "{analysis}/LST-1.Run{run_id}.dl3.fits.gz",
         config=config_dir / "{analysis}/bkgmodel.yml",
         script=scripts / "precompute_background_maps.py",
         bkg_exclusion_regions=config_dir / "{analysis}/bkg_exclusion",
+    wildcard_constraints:
+        run_id="\d+",
     conda:
         bkg_env
     resources:
-        partition="long",
-        time=360,
-        mem_mb=32000,
+        partition="short",
+        time=30,
+        mem_mb=8000,
     log:
-        dl3 / "{analysis}/calc_count_maps.log",
+        dl3 / "{analysis}/bkg_maps/{run_id}.log",
     shell:
         """python {input.script} \
-        --input-runs {input.runs} \
+        --input-run {input.run} \
         --exclusion {input.bkg_exclusion_regions} \
-        --output {output} \
+        --output-maps {output} \
         --config {input.config} \
         --log-file {log} \
-        --verbose \
-        --overwrite
+        --verbose
+        """
+
+
+def BKG_RUN_MAPS(wildcards):
+    ids = RUN_IDS(wildcards)
+    return [dl3 / f"{wildcards.analysis}/bkg_maps/{run}.npz" for run in ids]
+
+
+rule calc_count_maps:
+    output:
+        dl3 / "{analysis}/bkg_cached_maps.json",
+    input:
+        maps=BKG_RUN_MAPS,
+        script=scripts / "merge_background_maps.py",
+    conda:
+        bkg_env
+    resources:
+        partition="short",
+    log:
+        dl3 / "{analysis}/calc_count_maps.log",
+    shell:
+        """python {input.script} \
+        --input-maps {input.maps} \
+        --output {output} \
+        --log-file {log}
         """
 
 
 rule calc_background:
     output:
         dummy=dl3 / "{analysis}/bkg-exists",
+        mapping=dl3 / "{analysis}/bkg_files.json",
     input:
         runs=DL3_FILES,
         config=config_dir / "{analysis}/bkgmodel.yml",
         script=scripts / "calc_background.py",
-        cached_maps=dl3 / "{analysis}/bkg_cached_maps.pkl",
+        cached_maps=dl3 / "{analysis}/bkg_cached_maps.json",
         bkg_exclusion_regions=config_dir / "{analysis}/bkg_exclusion",
     params:
         bkg_dir=lambda wc: dl3 / wc.get("analysis"),
@@ -104,6 +131,7 @@ rule calc_background:
         --output-dir {params.bkg_dir} \
         --exclusion {input.bkg_exclusion_regions} \
         --dummy-output {output.dummy} \
+        --output-mapping {output.mapping} \
         --cached-maps {input.cached_maps} \
         --config {input.config} \
         --log-file {log} \
@@ -124,11 +152,12 @@ rule dl3_hdu_index:
         runs=DL3_FILES,
         index_script=scripts / "create_hdu_index.py",
         link_script=scripts / "link_bkg.py",
-        dummy=dl3 / "{analysis}/bkg-exists",
+        bkg_mapping=dl3 / "{analysis}/bkg_files.json",
     params:
         outdir=lambda wc: dl3 / wc.get("analysis"),
-        bkg=BKG_FILES,
         filelist=DL3_INDEX_FILELIST,
+        # scriptutils is not installed in the lstchain env
+        scriptutils=scriptutils_dir.absolute(),
     conda:
         lstchain_env
     log:
@@ -142,9 +171,9 @@ rule dl3_hdu_index:
             --overwrite \
             --log-file {log}
 
-        python {input.link_script} \
+        PYTHONPATH={params.scriptutils} python {input.link_script} \
         --hdu-index-path {output} \
-        --bkg-files {params.bkg} \
+        --bkg-mapping {input.bkg_mapping} \
         """
 
 
@@ -244,18 +273,15 @@ rule plot_background:
     output:
         dl3 / "{analysis}/plots/bkg/bkg_{run_id}.pdf",
     input:
-        data=dl3 / "{analysis}/bkg-exists",
+        mapping=dl3 / "{analysis}/bkg_files.json",
         script=scripts / "plot_bkg.py",
         rc=MATPLOTLIBRC,
-    params:
-        data=lambda wildcards: dl3
-        / f"{wildcards.analysis}/bkg_{wildcards.run_id}.fits.gz",
     conda:
         gammapy_env
     log:
         dl3 / "{analysis}/plots/bkg/bkg_{run_id}.log",
     shell:
-        "MATPLOTLIBRC={input.rc} python {input.script} -i {params.data} -o {output}"
+        "MATPLOTLIBRC={input.rc} python {input.script} --bkg-mapping {input.mapping} --obs-id {wildcards.run_id} -o {output}"
 
 
 rule calc_skymap: